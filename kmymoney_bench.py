@@ -0,0 +1,462 @@
+#! /usr/bin/python3
+# Benchmark of kmymoney_utils on synthetic KMyMoney files
+# Functionality: check the help message
+# License: GPL v3.0
+
+import xml.etree.ElementTree as ET
+import sys
+import os
+import io
+import json
+import time
+import random
+import getopt
+import resource
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import kmymoney_utils as ku
+
+# Top-level accounts: (ID, type, name)
+StandardAccounts = [
+    ("AStd::Asset", "Asset", "Asset"),
+    ("AStd::Liability", "Liability", "Liability"),
+    ("AStd::Expense", "Expense", "Expense"),
+    ("AStd::Income", "Income", "Income"),
+    ("AStd::Equity", "Equity", "Equity"),
+]
+
+# Type of accounts generated under every top-level account
+SubAccountTypes = {
+    "AStd::Asset": "Checkings",
+    "AStd::Liability": "CreditCard",
+    "AStd::Expense": "Expense",
+    "AStd::Income": "Income",
+    "AStd::Equity": "Equity",
+}
+
+# Relative frequency of transactions with given count of splits
+DefaultSplitWeights = {1: 2, 2: 80, 3: 12, 4: 6}
+
+# Options enabling every fixer on a generated file
+FixerOpts = {
+    "find_mismatches_in_slits": {"split_type": "2"},
+    "erase_number": {"to_erase_number": True},
+    "fix_reconcile_flag": {"reconcile_flag": "2"},
+    "assign_txn_numbers": {"set_txn_numbers_flag": True},
+    "add_default_tag": {"to_add_default_tag": True, "default_tag": "tag_1", "excluded_tags": ["tag_2", "tag_3"]},
+    "replace_tag_in_account": {
+        "set_replace_tag_in_account_flag": True,
+        "replace_target_account": "Expenses:",
+        "old_tag": "tag_1",
+        "new_tag": "tag_2",
+    },
+    "move_tag_from_split_level_to_txn_level": {"set_move_split_lvl_tag_to_txn_lvl": True, "tag_to_move": "tag_1"},
+    "reorder_tags_in_txn": {"to_reorder_tags": True},
+    "replace_payee": {"to_replace_payee": True, "payee_rules": [("^Payee 1", "Payee 0")]},
+}
+
+
+def attrs_to_str(attrs):
+    return " ".join([f'{k}="{ku.escape_attrib(v)}"' for k, v in attrs.items()])
+
+
+def generate_accounts(rnd, n_accounts, max_depth):
+    # Accounts are spread over the top-level accounts, each new account is a child of
+    # a random account not deeper than "max_depth" in the same hierarchy
+    accounts = []
+    for acnt_id, acnt_type, acnt_name in StandardAccounts:
+        accounts.append(
+            {"id": acnt_id, "parentaccount": "", "type": acnt_type, "name": acnt_name, "depth": 0, "top": acnt_id}
+        )
+    for i in range(1, n_accounts + 1):
+        top_acnt_id = rnd.choice(["AStd::Asset", "AStd::Expense", "AStd::Expense", "AStd::Income", "AStd::Liability"])
+        parents = [k for k in accounts if (k["top"] == top_acnt_id) and (k["depth"] < max_depth)]
+        parent = rnd.choice(parents)
+        accounts.append(
+            {
+                "id": f"A{i:06d}",
+                "parentaccount": parent["id"],
+                "type": SubAccountTypes[top_acnt_id],
+                "name": f"Account {i}",
+                "depth": parent["depth"] + 1,
+                "top": top_acnt_id,
+            }
+        )
+    return accounts
+
+
+def generate_file(outputfile, n_txns, n_accounts=50, max_depth=3, n_payees=100, n_tags=10, split_weights=None, seed=1):
+    # Write a synthetic KMyMoney file, "split_weights" maps a count of splits in a transaction
+    # to its relative frequency
+    if split_weights is None:
+        split_weights = DefaultSplitWeights
+    rnd = random.Random(seed)
+    accounts = generate_accounts(rnd, n_accounts, max_depth)
+    src_acnts = [k["id"] for k in accounts if (k["depth"] > 0) and (k["top"] in ("AStd::Asset", "AStd::Liability"))]
+    dst_acnts = [k["id"] for k in accounts if (k["depth"] > 0) and (k["top"] in ("AStd::Expense", "AStd::Income"))]
+    subaccounts = {k["id"]: [] for k in accounts}
+    for k in accounts[len(StandardAccounts):]:
+        subaccounts[k["parentaccount"]].append(k["id"])
+    if (len(src_acnts) == 0) or (len(dst_acnts) == 0):
+        raise ValueError("Too few accounts to generate transactions.")
+    payees = [(f"P{i:06d}", f"Payee {i}") for i in range(max(n_payees, 1))]
+    tags = [(f"G{i:06d}", f"tag_{i}") for i in range(max(n_tags, 4))]
+    split_counts = list(split_weights.keys())
+    split_count_weights = list(split_weights.values())
+
+    with ku.open_output(outputfile) as f:
+        w = f.write
+        w(ku.DOC_TYPE)
+        w("<KMYMONEY-FILE>\n")
+        w(' <FILEINFO>\n  <CREATION_DATE date="2000-01-01"/>\n  <LAST_MODIFIED_DATE date="2000-01-01"/>\n')
+        w('  <VERSION id="1"/>\n  <FIXVERSION id="5"/>\n </FILEINFO>\n')
+        w(' <USER email="" name="">\n  <ADDRESS telephone="" city="" county="" zipcode="" street=""/>\n </USER>\n')
+        w(' <INSTITUTIONS count="0"/>\n')
+
+        # ============== PAYEES =====================
+        w(f' <PAYEES count="{len(payees)}">\n')
+        for payee_id, payee_name in payees:
+            attrs = {"id": payee_id, "name": payee_name, "email": "", "reference": "", "matchingenabled": "0"}
+            w(f"  <PAYEE {attrs_to_str(attrs)}>\n")
+            w('   <ADDRESS telephone="" state="" city="" street="" postcode=""/>\n  </PAYEE>\n')
+        w(" </PAYEES>\n")
+        w(' <COSTCENTERS count="0"/>\n')
+
+        # ================ TAGS =====================
+        w(f' <TAGS count="{len(tags)}">\n')
+        for tag_id, tag_name in tags:
+            w(f'  <TAG {attrs_to_str({"id": tag_id, "name": tag_name, "closed": "0", "tagcolor": "#000000"})}/>\n')
+        w(" </TAGS>\n")
+
+        # ============== ACCOUNTS ===================
+        w(f' <ACCOUNTS count="{len(accounts)}">\n')
+        for acnt in accounts:
+            attrs = {
+                "id": acnt["id"],
+                "parentaccount": acnt["parentaccount"],
+                "lastreconciled": "",
+                "lastmodified": "",
+                "institution": "",
+                "number": "",
+                "opened": "2000-01-01",
+                "currency": "EUR",
+                "type": str(ku.AccountTypes[acnt["type"]]),
+                "name": acnt["name"],
+                "description": "",
+            }
+            if len(subaccounts[acnt["id"]]) == 0:
+                w(f"  <ACCOUNT {attrs_to_str(attrs)}/>\n")
+                continue
+            w(f"  <ACCOUNT {attrs_to_str(attrs)}>\n   <SUBACCOUNTS>\n")
+            for k in subaccounts[acnt["id"]]:
+                w(f'    <SUBACCOUNT id="{k}"/>\n')
+            w("   </SUBACCOUNTS>\n  </ACCOUNT>\n")
+        w(" </ACCOUNTS>\n")
+
+        # ============== TRANSACTIONS ===============
+        w(f' <TRANSACTIONS count="{n_txns}">\n')
+        for i in range(n_txns):
+            date = f"{rnd.randint(2000, 2024)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+            attrs = {"id": f"T{i + 1:018d}", "postdate": date, "memo": "", "entrydate": date, "commodity": "EUR"}
+            w(f"  <TRANSACTION {attrs_to_str(attrs)}>\n   <SPLITS>\n")
+            n_splits = rnd.choices(split_counts, weights=split_count_weights)[0]
+            payee_id = rnd.choice(payees)[0]
+            amount = rnd.randint(1, 100000)
+            for j in range(n_splits):
+                if j == 0:
+                    acnt_id = rnd.choice(src_acnts)
+                    value = f"{-amount}/100"
+                elif j < n_splits - 1:
+                    acnt_id = rnd.choice(dst_acnts)
+                    value = f"{amount // (n_splits - 1)}/100"
+                else:
+                    # The last split gets the remainder, so that the transaction is balanced
+                    acnt_id = rnd.choice(dst_acnts)
+                    value = f"{amount - (amount // (n_splits - 1)) * (n_splits - 2)}/100"
+                attrs = {
+                    "id": f"S{j + 1:04d}",
+                    "payee": payee_id if (j == 0) or (rnd.random() < 0.9) else "",
+                    "reconciledate": "",
+                    "action": "",
+                    "reconcileflag": rnd.choice(["0", "1", "2"]),
+                    "value": value,
+                    "shares": value,
+                    "price": "1/1",
+                    "memo": rnd.choice(["", "", "", "Memo", "Multi-line\nmemo"]),
+                    "account": acnt_id,
+                    "number": rnd.choice(["", "", str(i)]),
+                    "bankid": "",
+                }
+                split_tags = rnd.sample(tags, rnd.choice([0, 0, 1, 1, 2]))
+                if len(split_tags) == 0:
+                    w(f"    <SPLIT {attrs_to_str(attrs)}/>\n")
+                    continue
+                w(f"    <SPLIT {attrs_to_str(attrs)}>\n")
+                for tag_id, tag_name in split_tags:
+                    w(f'     <TAG id="{tag_id}"/>\n')
+                w("    </SPLIT>\n")
+            w("   </SPLITS>\n  </TRANSACTION>\n")
+        w(" </TRANSACTIONS>\n")
+        w(' <KEYVALUEPAIRS>\n  <PAIR key="kmm-baseCurrency" value="EUR"/>\n </KEYVALUEPAIRS>\n')
+        w(' <SCHEDULES count="0"/>\n <SECURITIES count="0"/>\n <CURRENCIES count="0"/>\n')
+        w(' <PRICES count="0"/>\n <REPORTS count="0"/>\n <BUDGETS count="0"/>\n <ONLINEJOBS count="0"/>\n')
+        w("</KMYMONEY-FILE>\n")
+    return
+
+
+# ============== BENCHMARK CASES ============
+def parse_file(inputfile):
+    parser = ET.XMLParser(encoding="utf-8")
+    with ku.open_input(inputfile) as f_in:
+        return ET.parse(f_in, parser=parser).getroot()
+
+
+def default_opts(extra_opts):
+    opts = {"excluded_tags": [], "compress_level": None}
+    opts.update(extra_opts)
+    return opts
+
+
+def reset_peak_rss():
+    # Peak resident set size of the process is reset to the current one (Linux 4.0+), so that the peak
+    # measured afterwards belongs to the timed operation and not to its preparation (e.g. parsing for
+    # fixers). Returns the current resident set size in MiB or None if the peak cannot be reset.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return None
+
+
+def run_case(case, inputfile, outputfile):
+    # Run a single benchmark case and measure only the operation itself.
+    # Returns wall time of the operation in seconds and the resident set size in MiB
+    # before the operation (see "reset_peak_rss").
+    if case == "parse":
+        rss = reset_peak_rss()
+        t = time.perf_counter()
+        ku.load_document(inputfile)
+        return time.perf_counter() - t, rss
+
+    if case == "serialize":
+        root, transactions = ku.load_document(inputfile)
+        rss = reset_peak_rss()
+        t = time.perf_counter()
+        ku.write_output(root, outputfile, transactions=transactions)
+        return time.perf_counter() - t, rss
+
+    if case in ("full run", "full run (stream)"):
+        opts = default_opts({})
+        for k in FixerOpts.values():
+            opts.update(k)
+        if case == "full run (stream)":
+            opts["to_stream"] = True
+        rss = reset_peak_rss()
+        t = time.perf_counter()
+        ku.fix_file(inputfile, outputfile, opts)
+        return time.perf_counter() - t, rss
+
+    # Fixers
+    opts = default_opts(FixerOpts[case])
+    root, transactions = ku.load_document(inputfile)
+    state = ku.prepare_fixers(root, opts, transactions=ku.txn_split_accounts(transactions))
+    rss = reset_peak_rss()
+    t = time.perf_counter()
+    ku.apply_transaction_fixers(transactions, state, opts)
+    return time.perf_counter() - t, rss
+
+
+def run_case_in_worker(case, inputfile, outputfile):
+    # Reports printed by the fixers are discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, rss = run_case(case, inputfile, outputfile)
+    # Peak resident set size of the worker process in MiB (ru_maxrss is in KiB on Linux),
+    # it includes the preparation of the operation if the peak could not be reset
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    rss_increase = peak_rss - rss if rss is not None else None
+    return seconds, peak_rss, rss_increase
+
+
+def benchmark(inputfile, n_txns, cases, repeat=1):
+    # Every case runs in a fresh process, so that the peak RSS belongs to the case alone.
+    # Peak RSS of an operation includes the memory held before it (e.g. the parsed document for fixers),
+    # RSS increase is the growth of the peak over it during the operation.
+    results = []
+    outputfile = f"{inputfile}.bench_output.xml"
+    ctx = multiprocessing.get_context("spawn")
+    for case in cases:
+        timings = []
+        peak_rss = 0
+        rss_increase = None
+        for k in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                seconds, rss, increase = pool.submit(run_case_in_worker, case, inputfile, outputfile).result()
+            timings.append(seconds)
+            peak_rss = max(peak_rss, rss)
+            if increase is not None:
+                rss_increase = max(rss_increase or 0, increase)
+        seconds = min(timings)
+        results.append(
+            {
+                "operation": case,
+                "seconds": seconds,
+                "peak_rss_mib": peak_rss,
+                "rss_increase_mib": rss_increase,
+                "txns_per_second": n_txns / seconds if seconds > 0 else None,
+            }
+        )
+        print_result(results[-1])
+    if os.path.exists(outputfile):
+        os.remove(outputfile)
+    return results
+
+
+def print_result(result):
+    txns_per_second = result["txns_per_second"]
+    throughput = f"{txns_per_second:14.0f}" if txns_per_second is not None else f"{'-':>14}"
+    rss_increase = result["rss_increase_mib"]
+    increase = f"{rss_increase:14.1f}" if rss_increase is not None else f"{'-':>14}"
+    print(f"{result['operation']:<40} {result['seconds']:10.3f} {result['peak_rss_mib']:13.1f} {increase} {throughput}")
+    return
+
+
+def print_help():
+    print(f"python3 {sys.argv[0]} [options/flags] [-i <inputfile>] [-o <report>.json]\n")
+    print(
+        'Input arguments:\n\
+    -n --transactions <count>            Number of transactions in the generated file (default: 100000).\n\
+    -a --accounts <count>                Number of accounts below top-level accounts (default: 50).\n\
+    -d --depth <depth>                   Maximum depth of the account hierarchy (default: 3).\n\
+    -p --payees <count>                  Number of payees (default: 100).\n\
+    -t --tags <count>                    Number of tags (default: 10).\n\
+    -s --splits <count>:<weight>,...     Relative frequency of transactions with given number of splits\n\
+                                         (default: "1:2,2:80,3:12,4:6").\n\
+    -r --repeat <count>                  Run every operation <count> times and report the fastest run (default: 1).\n\
+    -c --cases <case1>,<case2>           Run only given operations: "parse", "serialize", fixer function names,\n\
+                                         "full run", "full run (stream)" (default: all of them).\n\
+    -g --generate-only <file>            Generate a file (compressed if its extension is ".kmy") and exit.\n\
+    -i --input <file>                    Benchmark an existing KMyMoney file instead of a generated one.\n\
+    -k --keep                            Keep the generated file.\n\
+    -o --output <report>.json            Write results to a JSON file to compare runs.\n\
+    -m --max-stream-rss <MiB>            Exit with status 1 if the RSS increase of "full run (stream)" exceeds <MiB>.\n\
+                                         Memory of the streaming mode should not grow with the size of the file.\n\
+    --seed <seed>                        Seed of the random generator (default: 1).\n\
+    -h --help                            Print this help message.\
+    '
+    )
+    return
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(
+            argv[1:],
+            "n:a:d:p:t:s:r:c:g:i:ko:m:h",
+            [
+                "transactions=",
+                "accounts=",
+                "depth=",
+                "payees=",
+                "tags=",
+                "splits=",
+                "repeat=",
+                "cases=",
+                "generate-only=",
+                "input=",
+                "keep",
+                "output=",
+                "max-stream-rss=",
+                "seed=",
+                "help",
+            ],
+        )
+        gen_opts = {"n_txns": 100000, "split_weights": DefaultSplitWeights}
+        repeat = 1
+        cases = ["parse"] + list(FixerOpts.keys()) + ["serialize", "full run", "full run (stream)"]
+        generate_only = None
+        inputfile = None
+        keep = False
+        reportfile = None
+        max_stream_rss = None
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print_help()
+                sys.exit()
+            elif opt in ("-n", "--transactions"):
+                gen_opts["n_txns"] = int(arg)
+            elif opt in ("-a", "--accounts"):
+                gen_opts["n_accounts"] = int(arg)
+            elif opt in ("-d", "--depth"):
+                gen_opts["max_depth"] = int(arg)
+            elif opt in ("-p", "--payees"):
+                gen_opts["n_payees"] = int(arg)
+            elif opt in ("-t", "--tags"):
+                gen_opts["n_tags"] = int(arg)
+            elif opt in ("-s", "--splits"):
+                gen_opts["split_weights"] = {int(k.split(":")[0]): float(k.split(":")[1]) for k in arg.split(",")}
+            elif opt in ("-r", "--repeat"):
+                repeat = int(arg)
+            elif opt in ("-c", "--cases"):
+                cases = arg.split(",")
+            elif opt in ("-g", "--generate-only"):
+                generate_only = arg
+            elif opt in ("-i", "--input"):
+                inputfile = arg
+            elif opt in ("-k", "--keep"):
+                keep = True
+            elif opt in ("-o", "--output"):
+                reportfile = arg
+            elif opt in ("-m", "--max-stream-rss"):
+                max_stream_rss = float(arg)
+            elif opt == "--seed":
+                gen_opts["seed"] = int(arg)
+    except (getopt.GetoptError, ValueError, IndexError):
+        print_help()
+        sys.exit(2)
+
+    if generate_only is not None:
+        generate_file(generate_only, **gen_opts)
+        return
+
+    generated = inputfile is None
+    if generated:
+        inputfile = f"kmymoney_bench_{gen_opts['n_txns']}.xml"
+        t = time.perf_counter()
+        generate_file(inputfile, **gen_opts)
+        print(f"Generated {inputfile} in {time.perf_counter() - t:.1f} s")
+    else:
+        gen_opts["n_txns"] = len(parse_file(inputfile).findall("./TRANSACTIONS/TRANSACTION"))
+    file_size = os.path.getsize(inputfile)
+    print(f"File size: {file_size / 2**20:.1f} MiB, transactions: {gen_opts['n_txns']}\n")
+
+    print(f"{'Operation':<40} {'Time, s':>10} {'Peak RSS, MiB':>13} {'RSS +, MiB':>14} {'Txns/s':>14}")
+    try:
+        results = benchmark(inputfile, gen_opts["n_txns"], cases, repeat)
+    finally:
+        if generated and not keep:
+            os.remove(inputfile)
+
+    if reportfile is not None:
+        report = {"file": inputfile, "file_size": file_size, "generated": generated}
+        report["generator"] = {k: v for k, v in gen_opts.items() if k != "split_weights"}
+        report["generator"]["split_weights"] = {str(k): v for k, v in gen_opts["split_weights"].items()}
+        report["results"] = results
+        with open(reportfile, "w", encoding="UTF-8") as f:
+            json.dump(report, f, indent=2)
+
+    if max_stream_rss is not None:
+        for result in results:
+            rss_increase = result["rss_increase_mib"]
+            if (result["operation"] == "full run (stream)") and (rss_increase is not None) \
+                    and (rss_increase > max_stream_rss):
+                print(f"\nRSS increase of streaming run {rss_increase:.1f} MiB exceeds {max_stream_rss:.1f} MiB.")
+                sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -8,6 +8,36 @@ import xml.etree.ElementTree as ET
 import sys
 import re
 import getopt
+import gzip
+import functools
+import os
+import io
+import glob
+import contextlib
+import json
+import time
+import tracemalloc
+import hashlib
+import sqlite3
+import csv
+import collections
+import mmap
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from decimal import Decimal, localcontext
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Account types are defined in:
 # Repo: https://invent.kde.org/office/kmymoney
@@ -38,82 +68,336 @@ AccountTypesInv = {v: k for k, v in AccountTypes.items()}
 AccountRenaming = {"Asset": "Assets", "Liability": "Liabilities", "Expense": "Expenses"}
 
 
-def traverse_account_hierarchy_backwards(accounts, acnt_id):
-    if accounts[acnt_id]["parentaccount"] == "":
-        acnt_name = accounts[acnt_id]["name"]
-        if acnt_name in AccountRenaming.keys():
-            acnt_name = AccountRenaming[acnt_name]
-        return acnt_name
-    else:
-        parent_acnt_name = traverse_account_hierarchy_backwards(
-            accounts, accounts[acnt_id]["parentaccount"]
-        )
-    acnt_name = accounts[acnt_id]["name"]
-    return f"{parent_acnt_name}:{acnt_name}"
+# ============== MODEL ======================
+# Lookup tables and transactions are loaded into compact objects. IDs, dates and whitespace
+# between elements recur all over the file, so they are interned. Account types and reconcile
+# flags are stored as integers. Splits and transactions keep the order of their attributes,
+# the text between their elements and any child elements they do not model (e.g. KEYVALUEPAIRS),
+# so that they are written back exactly as they were read.
+SPLIT_FIELDS = ("payee", "reconciledate", "shares", "action", "bankid", "number", "reconcileflag", "memo",
+                "value", "price", "account", "id")
+TRANSACTION_FIELDS = ("id", "postdate", "memo", "entrydate", "commodity")
+INTERNED_FIELDS = {"payee", "reconciledate", "action", "bankid", "price", "account", "id", "postdate",
+                   "entrydate", "commodity"}
 
+# Tuples of attribute names are shared by all objects with the same attributes
+ATTRIBUTE_NAMES = dict()
 
-def find_mismatches_in_slits(transactions, accounts, payees, split_type):
-    cnt_all = 0
-    cnt_emp = 0
-    for i, item in enumerate(transactions):
-        txn_id = item.attrib["id"]
-        date = item.attrib["postdate"]
-        splits = item.findall("./SPLITS/SPLIT")
-        # Source account
-        src = splits[0].attrib
-        src_acnt_id = src["account"]
-        src_acnt_type = AccountTypesInv[int(accounts[src_acnt_id]["type"])]
-        src_acnt_name = traverse_account_hierarchy_backwards(accounts, src_acnt_id)
-        src_acnt_currency = accounts[src_acnt_id]["currency"]
-        src_amount = eval(src["price"]) * eval(src["value"])
-        src_memo = src["memo"]
-        src_payee_id = splits[0].attrib["payee"]
-        if src_payee_id != "":
-            src_payee_name = payees[src_payee_id]["name"]
+
+def intern_text(text):
+    if text is None:
+        return None
+    return sys.intern(text)
+
+
+def int_code(value):
+    # Integer-coded value if the string is its canonical representation, the string itself otherwise
+    try:
+        code = int(value)
+    except (TypeError, ValueError):
+        return value
+    if str(code) != value:
+        return value
+    return code
+
+
+def load_fields(obj, elem, fields):
+    # Attributes of an element are stored in the slots of the object, unknown ones in "extra"
+    attrib = elem.attrib
+    for name in fields:
+        value = attrib.get(name)
+        if (value is not None) and (name in INTERNED_FIELDS):
+            value = sys.intern(value)
+        setattr(obj, name, value)
+    names = tuple(attrib)
+    if names not in ATTRIBUTE_NAMES:
+        ATTRIBUTE_NAMES[names] = names
+    obj.names = ATTRIBUTE_NAMES[names]
+    obj.extra = None
+    if (len(names) > len(fields)) or (not all(name in fields for name in names)):
+        obj.extra = {name: value for name, value in attrib.items() if name not in fields}
+    return
+
+
+def field_items(obj, fields):
+    # Attributes in the order they were read, attributes set afterwards follow in the order of "fields"
+    for name in obj.names:
+        if name in fields:
+            yield name, str(getattr(obj, name))
+        else:
+            yield name, obj.extra[name]
+    for name in fields:
+        value = getattr(obj, name)
+        if (value is not None) and (name not in obj.names):
+            yield name, str(value)
+    return
+
+
+class Account:
+    __slots__ = ("id", "name", "parent", "type", "currency")
+
+    def __init__(self, elem):
+        self.id = sys.intern(elem.attrib["id"])
+        self.name = elem.attrib["name"]
+        self.parent = sys.intern(elem.attrib["parentaccount"])
+        self.type = int(elem.attrib["type"])
+        self.currency = elem.attrib["currency"]
+
+
+class Payee:
+    __slots__ = ("id", "name")
+
+    def __init__(self, elem):
+        self.id = sys.intern(elem.attrib["id"])
+        self.name = elem.attrib["name"]
+
+
+class Tag:
+    __slots__ = ("id", "name")
+
+    def __init__(self, elem):
+        self.id = sys.intern(elem.attrib["id"])
+        self.name = elem.attrib["name"]
+
+
+class Split:
+    # Tags of a split are stored as tag IDs among its children
+    __slots__ = SPLIT_FIELDS + ("names", "extra", "text", "children", "tails", "tail")
+
+    def __init__(self, elem):
+        load_fields(self, elem, SPLIT_FIELDS)
+        self.reconcileflag = int_code(self.reconcileflag)
+        self.text = intern_text(elem.text)
+        self.children = None
+        self.tails = None
+        if len(elem) > 0:
+            self.children = []
+            self.tails = []
+            for child in elem:
+                if (child.tag == "TAG") and (list(child.attrib) == ["id"]) and (len(child) == 0) and (not child.text):
+                    self.children.append(sys.intern(child.attrib["id"]))
+                else:
+                    self.children.append(child)
+                self.tails.append(intern_text(child.tail))
+        self.tail = intern_text(elem.tail)
+
+    def items(self):
+        return field_items(self, SPLIT_FIELDS)
+
+    def tag_ids(self):
+        if self.children is None:
+            return []
+        return [child for child in self.children if type(child) is str]
+
+    def add_tag(self, tag_id):
+        if self.children is None:
+            self.children = []
+            self.tails = []
+        self.children.append(tag_id)
+        self.tails.append(None)
+        return
+
+    def replace_tag(self, old_tag_id, new_tag_id):
+        # Replace the first occurrence of a tag, remove it if "new_tag_id" is None
+        i = self.children.index(old_tag_id)
+        if new_tag_id is None:
+            del self.children[i]
+            del self.tails[i]
         else:
-            src_payee_name = ""
-        # Check transaction with two splits (most of the transactions are of this type)
-        if (split_type == "2") and (len(list(splits)) == 2):
-            # Destination account
-            dst = splits[1].attrib
-            dst_payee_id = dst["payee"]
-            dst_acnt_id = dst["account"]
-            dst_acnt_type = AccountTypesInv[int(accounts[dst_acnt_id]["type"])]
-            dst_acnt_name = traverse_account_hierarchy_backwards(accounts, dst_acnt_id)
-            dst_acnt_currency = accounts[dst_acnt_id]["currency"]
-            dst_amount = eval(dst["price"]) * eval(dst["value"])
-            dst_memo = dst["memo"]
-            if dst_payee_id != "":
-                dst_payee_name = payees[dst_payee_id]["name"]
+            self.children[i] = new_tag_id
+        return
+
+    def sort_tags(self, key):
+        # Tags are reordered together with the text following them, other children are dropped
+        if self.children is None:
+            return
+        tags = [(child if type(child) is str else child.get("id"), child, tail)
+                for child, tail in zip(self.children, self.tails) if (type(child) is str) or (child.tag == "TAG")]
+        tags.sort(key=lambda k: key(k[0]))
+        self.children = [k[1] for k in tags]
+        self.tails = [k[2] for k in tags]
+        return
+
+
+class Transaction:
+    # Splits are stored in "splits", which takes the place of the SPLITS element among the children
+    __slots__ = TRANSACTION_FIELDS + ("names", "extra", "text", "splits", "splits_text", "children", "tails", "tail")
+
+    def __init__(self, elem):
+        load_fields(self, elem, TRANSACTION_FIELDS)
+        self.text = intern_text(elem.text)
+        self.splits = []
+        self.splits_text = None
+        self.children = []
+        self.tails = []
+        for child in elem:
+            if (child.tag == "SPLITS") and (len(child.attrib) == 0) and (len(self.splits) == 0) \
+                    and all(spl.tag == "SPLIT" for spl in child):
+                self.splits = [Split(spl) for spl in child]
+                self.splits_text = intern_text(child.text)
+                self.children.append(self.splits)
             else:
-                dst_payee_name = ""
-            # For a transaction with two splits, destination payee should match source payee.
-            # A mismatch is usually caused by an empty destination payee.
-            if src_payee_id != dst_payee_id:
-                print(f"Transaction {txn_id}")
-                print("Source and destination payee mismatch:")
-                print(f"Date: {date}")
-                print(f"Source payee ID: {src_payee_id}")
-                print(f"Source payee: {src_payee_name}")
-                print(f"Source account name  : {src_acnt_name}")
-                print(f"Source account type  : {src_acnt_type}")
-                print(f"Source account amount: {src_amount} {src_acnt_currency}")
-                print(f"Source payee memo: {src_memo}")
-
-                print(f"Desti. payee ID: {dst_payee_id}")
-                print(f"Desti. payee: {dst_payee_name}")
-                print(f"Desti. account name  : {dst_acnt_name}")
-                print(f"Desti. account type  : {dst_acnt_type}")
-                print(f"Desti. account amount: {dst_amount} {dst_acnt_currency}")
-                print(f"Desti. payee memo: {dst_memo}\n")
-                cnt_all += 1
-                if dst_payee_id == "":
-                    # Here an empty destination payee is replaced with transaction's source payee.
-                    splits[1].attrib["payee"] = src_payee_id
-                    cnt_emp += 1
-        elif (split_type == "1") and (len(list(splits)) == 1):
+                self.children.append(child)
+            self.tails.append(intern_text(child.tail))
+        self.tail = intern_text(elem.tail)
+
+    def items(self):
+        return field_items(self, TRANSACTION_FIELDS)
+
+
+def load_document(inputfile):
+    # Document tree without transactions, which are loaded into the model.
+    # Returns the root and the list of transactions.
+    transactions = []
+    pending_txn = None
+    section = None
+    txns_elem = None
+    depth = 0
+    with open_input(inputfile) as f_in:
+        parser = ET.XMLParser(encoding="utf-8")
+        for event, elem in ET.iterparse(f_in, events=("start", "end"), parser=parser):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2:
+                    section = elem
+                    if (txns_elem is None) and (elem.tag == "TRANSACTIONS"):
+                        txns_elem = elem
+            if (pending_txn is not None) and (event == "start" or depth == 2):
+                # Tail of a transaction is known at the start of the next one or at the end of TRANSACTIONS
+                transactions[-1].tail = intern_text(pending_txn.tail)
+                section.remove(pending_txn)
+                pending_txn = None
+            if event == "end":
+                if (depth == 3) and (elem.tag == "TRANSACTION") and (section is txns_elem):
+                    transactions.append(Transaction(elem))
+                    pending_txn = elem
+                depth -= 1
+    return root, transactions
+
+
+class AccountIndex:
+    # Account properties looked up for every split are computed once per file: full colon-joined
+    # names, IDs of top-level accounts, type names and whether an account is an income/expense account
+    def __init__(self, accounts):
+        self.full_name = dict()
+        self.top_id = dict()
+        self.type_name = dict()
+        self.is_inc_exp = dict()
+        self.id_by_name = dict()
+        for acnt_id, acnt in accounts.items():
+            self.type_name[acnt_id] = AccountTypesInv[acnt.type]
+            self.is_inc_exp[acnt_id] = self.type_name[acnt_id] in ["Income", "Expense"]
+        for acnt_id in accounts.keys():
+            acnt_name = self.resolve_full_name(accounts, acnt_id)
+            self.id_by_name[acnt_name] = acnt_id
+
+    def resolve_full_name(self, accounts, acnt_id):
+        # Walk up the hierarchy only until an account with an already known full name
+        # is reached, then fill in the names of all accounts passed on the way
+        chain = []
+        while acnt_id not in self.full_name:
+            parent_acnt_id = accounts[acnt_id].parent
+            if parent_acnt_id == "":
+                acnt_name = accounts[acnt_id].name
+                self.full_name[acnt_id] = AccountRenaming.get(acnt_name, acnt_name)
+                self.top_id[acnt_id] = acnt_id
+                break
+            chain.append(acnt_id)
+            if len(chain) > len(accounts):
+                raise ValueError(f"Account {acnt_id} is its own ancestor.")
+            acnt_id = parent_acnt_id
+        acnt_name = self.full_name[acnt_id]
+        top_id = self.top_id[acnt_id]
+        for k in reversed(chain):
+            acnt_name = f"{acnt_name}:{accounts[k].name}"
+            self.full_name[k] = acnt_name
+            self.top_id[k] = top_id
+        return acnt_name
+
+    def find_by_substring(self, substring):
+        # ID of the first account whose full name contains "substring"
+        for acnt_name, acnt_id in self.id_by_name.items():
+            if substring in acnt_name:
+                return acnt_id
+        return None
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_amount(value):
+    # KMyMoney stores values, shares and prices as "numerator/denominator" strings.
+    # The same strings (e.g. price "1/1") recur all over the file, hence the cache.
+    num, sep, den = value.partition("/")
+    if sep == "":
+        return Fraction(int(num))
+    return Fraction(int(num), int(den))
+
+
+def fraction_to_decimal(amount):
+    # Exact decimal representation of an amount, rounded to 28 significant digits
+    # if the fraction does not terminate
+    return Decimal(amount.numerator) / Decimal(amount.denominator)
+
+
+def exact_decimal(amount):
+    # Decimal string of an amount if its decimal representation terminates,
+    # "numerator/denominator" otherwise
+    den = amount.denominator
+    cnt_2 = 0
+    while den % 2 == 0:
+        den //= 2
+        cnt_2 += 1
+    cnt_5 = 0
+    while den % 5 == 0:
+        den //= 5
+        cnt_5 += 1
+    if den != 1:
+        return f"{amount.numerator}/{amount.denominator}"
+    scale = max(cnt_2, cnt_5)
+    return f"{Decimal(amount.numerator * 10**scale // amount.denominator).scaleb(-scale):f}"
+
+
+def find_mismatches_in_slits(item, splits, split_tags, state, opts):
+    accounts = state["accounts"]
+    acnt_index = state["account_index"]
+    payees = state["payees"]
+    split_type = opts["split_type"]
+    txn_id = item.id
+    date = item.postdate
+    # Source account
+    src = splits[0]
+    src_acnt_id = src.account
+    src_acnt_type = acnt_index.type_name[src_acnt_id]
+    src_acnt_name = acnt_index.full_name[src_acnt_id]
+    src_acnt_currency = accounts[src_acnt_id].currency
+    src_amount = fraction_to_decimal(parse_amount(src.price) * parse_amount(src.value))
+    src_memo = src.memo
+    src_payee_id = src.payee
+    if src_payee_id != "":
+        src_payee_name = payees[src_payee_id].name
+    else:
+        src_payee_name = ""
+    # Check transaction with two splits (most of the transactions are of this type)
+    if (split_type == "2") and (len(splits) == 2):
+        # Destination account
+        dst = splits[1]
+        dst_payee_id = dst.payee
+        dst_acnt_id = dst.account
+        dst_acnt_type = acnt_index.type_name[dst_acnt_id]
+        dst_acnt_name = acnt_index.full_name[dst_acnt_id]
+        dst_acnt_currency = accounts[dst_acnt_id].currency
+        dst_amount = fraction_to_decimal(parse_amount(dst.price) * parse_amount(dst.value))
+        dst_memo = dst.memo
+        if dst_payee_id != "":
+            dst_payee_name = payees[dst_payee_id].name
+        else:
+            dst_payee_name = ""
+        # For a transaction with two splits, destination payee should match source payee.
+        # A mismatch is usually caused by an empty destination payee.
+        if src_payee_id != dst_payee_id:
             print(f"Transaction {txn_id}")
-            print("No second split!")
+            print("Source and destination payee mismatch:")
             print(f"Date: {date}")
             print(f"Source payee ID: {src_payee_id}")
             print(f"Source payee: {src_payee_name}")
@@ -121,8 +405,33 @@ def find_mismatches_in_slits(transactions, accounts, payees, split_type):
             print(f"Source account type  : {src_acnt_type}")
             print(f"Source account amount: {src_amount} {src_acnt_currency}")
             print(f"Source payee memo: {src_memo}")
-            cnt_all += 1
 
+            print(f"Desti. payee ID: {dst_payee_id}")
+            print(f"Desti. payee: {dst_payee_name}")
+            print(f"Desti. account name  : {dst_acnt_name}")
+            print(f"Desti. account type  : {dst_acnt_type}")
+            print(f"Desti. account amount: {dst_amount} {dst_acnt_currency}")
+            print(f"Desti. payee memo: {dst_memo}\n")
+            state["cnt_all"] += 1
+            if dst_payee_id == "":
+                # Here an empty destination payee is replaced with transaction's source payee.
+                splits[1].payee = src_payee_id
+                state["cnt_emp"] += 1
+    elif (split_type == "1") and (len(splits) == 1):
+        print(f"Transaction {txn_id}")
+        print("No second split!")
+        print(f"Date: {date}")
+        print(f"Source payee ID: {src_payee_id}")
+        print(f"Source payee: {src_payee_name}")
+        print(f"Source account name  : {src_acnt_name}")
+        print(f"Source account type  : {src_acnt_type}")
+        print(f"Source account amount: {src_amount} {src_acnt_currency}")
+        print(f"Source payee memo: {src_memo}")
+        state["cnt_all"] += 1
+    return
+
+
+def print_split_counts(split_type, cnt_all, cnt_emp):
     if split_type == "2":
         print(f"Count of mismatching source and destination splits: {cnt_all}")
         print(f"Count of transactions with one splits being empty: {cnt_emp}")
@@ -131,164 +440,311 @@ def find_mismatches_in_slits(transactions, accounts, payees, split_type):
     return
 
 
-def add_default_tag(transactions, accounts, tags, default_tag, excluded_tags):
-    excluded_tags_ext = excluded_tags + [default_tag]
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
-        txn_id = item.attrib["id"]
-        # Check if any of destination splits is affiliated with "excluded_tags"
-        spl_ex_tags = []
-        for k in excluded_tags_ext:
-            spl_ex_tags = spl_ex_tags + item.findall(f'./SPLITS/SPLIT/TAG[@id="{tags[k]}"]')
+# A fixer working with tags gets "split_tags", a list holding the set of tag IDs of every split
+# in the transaction. Tags are added and removed through the functions below, which keep
+# these sets in sync, so that tag membership checks do not need to scan the splits.
+def split_tag_ids(spl):
+    return set(spl.tag_ids())
 
-        # Check if all destination splits refer to Income or Expense accounts
-        if_dst_inc_exp = 0
-        dst_acnt_type = {}
-        for j, spl in enumerate(splits[1:], 1):
-            # Destination account
-            dst = spl.attrib
-            dst_acnt_id = dst["account"]
-            dst_acnt_type[j] = AccountTypesInv[int(accounts[dst_acnt_id]["type"])]
-            if_dst_inc_exp =+ (dst_acnt_type[j] in ["Income", "Expense"])
-
-        # If number of splits is 2 (minimal necessary) or more and the splits are not affiliated with
-        # "excluded_tags", then assign default tag
-        if (len(spl_ex_tags) == 0) and if_dst_inc_exp:
-            dt = ET.SubElement(splits[0], "TAG")
-            dt.attrib["id"] = tags[default_tag]
-        elif (len(splits) > 2):
-            for j, spl in enumerate(splits[1:], 1):
-                mspl_ex_tags = []
-                for k in excluded_tags_ext:
-                    mspl_ex_tags = mspl_ex_tags + spl.findall(f'./TAG[@id="{tags[k]}"]')
 
-                if (len(mspl_ex_tags) == 0) & (dst_acnt_type[j] in ["Income", "Expense"]):
-                    dt = ET.SubElement(spl, "TAG")
-                    dt.attrib["id"] = tags[default_tag]
+def add_tag(spl, spl_tags, tag_id):
+    spl.add_tag(tag_id)
+    spl_tags.add(tag_id)
     return
 
 
-def replace_tag_in_account(transactions, tags, target_acnt_id, old_tag, new_tag):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
+def replace_tag(spl, spl_tags, old_tag_id, new_tag_id):
+    # Replace the first occurrence of a tag in a split, a no-op if the split does not possess the tag
+    if old_tag_id not in spl_tags:
+        return None
+    cnt_old = spl.tag_ids().count(old_tag_id)
+    spl.replace_tag(old_tag_id, new_tag_id)
+    if new_tag_id is not None:
+        spl_tags.add(new_tag_id)
+    if cnt_old == 1:
+        spl_tags.discard(old_tag_id)
+    return old_tag_id
+
+
+def remove_tag(spl, spl_tags, tag_id):
+    return replace_tag(spl, spl_tags, tag_id, None)
+
+
+def add_default_tag(item, splits, split_tags, state, opts):
+    is_inc_exp = state["account_index"].is_inc_exp
+    default_tag_id = state["default_tag_id"]
+    excluded_tag_ids = state["excluded_tag_ids"]
+    if default_tag_id is None:
+        return
+    # Check if any of splits is affiliated with "excluded_tags"
+    is_txn_excluded = False
+    for spl_tags in split_tags:
+        if not excluded_tag_ids.isdisjoint(spl_tags):
+            is_txn_excluded = True
+            break
+
+    # Check if all destination splits refer to Income or Expense accounts
+    if_dst_inc_exp = 0
+    dst_inc_exp = {}
+    for j, spl in enumerate(splits[1:], 1):
+        # Destination account
+        dst_acnt_id = spl.account
+        dst_inc_exp[j] = is_inc_exp[dst_acnt_id]
+        if_dst_inc_exp =+ dst_inc_exp[j]
+
+    # If number of splits is 2 (minimal necessary) or more and the splits are not affiliated with
+    # "excluded_tags", then assign default tag
+    if (not is_txn_excluded) and if_dst_inc_exp:
+        add_tag(splits[0], split_tags[0], default_tag_id)
+    elif (len(splits) > 2):
+        for j, spl in enumerate(splits[1:], 1):
+            if excluded_tag_ids.isdisjoint(split_tags[j]) and dst_inc_exp[j]:
+                add_tag(spl, split_tags[j], default_tag_id)
+    return
 
-        if len(splits) == 2:
-            # For two-split transaction, tag is stored at the first split
-            if splits[1].attrib["account"] == target_acnt_id:
-                dt = splits[0].findall(f'./TAG[@id="{tags[old_tag]}"]')
-                if len(dt) > 0:
-                    dt[0].attrib["id"] = tags[new_tag]
-        else:
-            for j, spl in enumerate(splits[1:], 1):
-                if spl.attrib["account"] == target_acnt_id:
-                    dt = spl.findall(f'./TAG[@id="{tags[old_tag]}"]')
-                    if len(dt) > 0:
-                        dt[0].attrib["id"] = tags[new_tag]
+
+def replace_tag_in_account(item, splits, split_tags, state, opts):
+    target_acnt_id = state["replace_target_acnt_id"]
+    old_tag_id = state["old_tag_id"]
+    new_tag_id = state["new_tag_id"]
+    if target_acnt_id is None:
+        return
+    if len(splits) == 2:
+        # For two-split transaction, tag is stored at the first split
+        if splits[1].account == target_acnt_id:
+            replace_tag(splits[0], split_tags[0], old_tag_id, new_tag_id)
+    else:
+        for j, spl in enumerate(splits[1:], 1):
+            if spl.account == target_acnt_id:
+                replace_tag(spl, split_tags[j], old_tag_id, new_tag_id)
     return
 
 
-def move_tag_from_split_level_to_txn_level(transactions, tags, tag_to_move, accounts):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
+def move_tag_from_split_level_to_txn_level(item, splits, split_tags, state, opts):
+    is_inc_exp = state["account_index"].is_inc_exp
+    tag_id = state["tag_to_move_id"]
+    if tag_id is None:
+        return
+
+    cnt_inc_exp_acnts = 0
+    cnt_tagged_splits = 0
+    if len(splits) > 2:
+        for j, spl in enumerate(splits[1:], 1):
+            if is_inc_exp[spl.account]:
+                cnt_inc_exp_acnts += 1
+                if tag_id in split_tags[j]:
+                    cnt_tagged_splits += 1
+
+        if cnt_inc_exp_acnts == cnt_tagged_splits:
+            # All income/expense splits possess "tag_to_move"
+            if tag_id not in split_tags[0]:
+                add_tag(splits[0], split_tags[0], tag_id)
 
-        cnt_inc_exp_acnts = 0
-        cnt_tagged_splits = 0
-        if len(splits) > 2:
             for j, spl in enumerate(splits[1:], 1):
-                acnt = spl.attrib["account"]
-                acnt_type = AccountTypesInv[int(accounts[acnt]["type"])]
-                if acnt_type in ["Income", "Expense"]:
-                    cnt_inc_exp_acnts += 1
-                    tagged_spl = spl.findall(f'./TAG[@id="{tags[tag_to_move]}"]')
-                    if len(tagged_spl) > 0:
-                        cnt_tagged_splits += 1
-
-            if cnt_inc_exp_acnts == cnt_tagged_splits:
-                # All income/expense splits possess "tag_to_move"
-                is_top_split_tagged = bool(splits[0].findall(f'./TAG[@id="{tags[tag_to_move]}"]'))
-                if not is_top_split_tagged:
-                    dt = ET.SubElement(splits[0], "TAG")
-                    dt.attrib["id"] = tags[tag_to_move]
-
-                for j, spl in enumerate(splits[1:], 1):
-                    acnt = spl.attrib["account"]
-                    acnt_type = AccountTypesInv[int(accounts[acnt]["type"])]
-                    if acnt_type in ["Income", "Expense"]:
-                        tagged_spl = spl.findall(f'./TAG[@id="{tags[tag_to_move]}"]')[0]
-                        if tagged_spl is not None:
-                            spl.remove(tagged_spl)
+                if is_inc_exp[spl.account]:
+                    remove_tag(spl, split_tags[j], tag_id)
     return
 
 
-def erase_number(transactions, to_erase_number):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
-        for spl in splits:
-            spl.attrib["number"] = ""
+def erase_number(item, splits, split_tags, state, opts):
+    for spl in splits:
+        spl.number = ""
     return
 
 
-def fix_reconcile_flag(transactions, reconcile_flag):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
-        for spl in splits:
-            spl.attrib["reconcileflag"] = reconcile_flag
+def fix_reconcile_flag(item, splits, split_tags, state, opts):
+    reconcile_flag = int_code(opts["reconcile_flag"])
+    for spl in splits:
+        spl.reconcileflag = reconcile_flag
     return
 
 
-def assign_txn_numbers(root, account):
-    splits = sorted(
-        root.findall(f'./TRANSACTIONS/TRANSACTION/SPLITS/SPLIT[@account="{account}"]'),
-        key=lambda child: (child.tag, child.get("postdate")),
-    )
-    for count, split in enumerate(splits, start=1):
-        split.set("number", str(count))
+def txn_split_accounts(transactions):
+    # Post date and account IDs of splits of every transaction
+    for item in transactions:
+        yield item.postdate or "", [spl.account for spl in item.splits]
     return
 
 
-def reorder_tags_in_txn(transactions, rev_tags):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
+def number_splits_chronologically(txn_accounts, account_ids):
+    # Splits of every account in "account_ids" are numbered by the post date of their transactions
+    # in a single pass, transactions with the same post date keep their order in the file.
+    # "txn_accounts" iterates over post dates and account IDs of splits of all transactions.
+    # Returns a dictionary mapping (transaction position, split position) to the split number.
+    acnt_splits = {acnt_id: [] for acnt_id in account_ids}
+    for i, (postdate, split_accounts) in enumerate(txn_accounts):
+        for j, account in enumerate(split_accounts):
+            if account in acnt_splits:
+                acnt_splits[account].append((postdate, i, j))
+    numbers = dict()
+    for splits in acnt_splits.values():
+        splits.sort()
+        for count, (postdate, i, j) in enumerate(splits, start=1):
+            numbers[(i, j)] = count
+    return numbers
+
+
+def assign_txn_numbers(item, splits, split_tags, state, opts):
+    # "txn_numbers" is computed in advance over all transactions, "txn_position" is
+    # the position of the current transaction in the file
+    numbers = state["txn_numbers"]
+    i = state["txn_position"]
+    state["txn_position"] += 1
+    for j, spl in enumerate(splits):
+        if (i, j) in numbers:
+            spl.number = str(numbers[(i, j)])
+    return
+
 
-        for j, spl in enumerate(splits, 1):
-            spl[:] = sorted(spl.findall(f'./TAG'), key=lambda child: rev_tags[child.get("id")])
+def reorder_tags_in_txn(item, splits, split_tags, state, opts):
+    rev_tags = state["rev_tags"]
+    for j, spl in enumerate(splits, 1):
+        spl.sort_tags(lambda tag_id: rev_tags[tag_id])
     return
 
 
-def replace_payee(transactions, payees, rev_payees, payee_pattern, payee_replacement):
-    for i, item in enumerate(transactions):
-        splits = item.findall("./SPLITS/SPLIT")
-        curr_payee = splits[0].attrib["payee"]
-        if (curr_payee != "") and re.match(payee_pattern, payees[curr_payee]["name"]):
-            if len(splits) == 2:
-                for spl in splits:
-                    spl.attrib["payee"] = rev_payees[payee_replacement]
-                    if spl.attrib["memo"] == "":
-                        spl.attrib["memo"] = payees[curr_payee]["name"]
-                    else:
-                        spl.attrib["memo"] = payees[curr_payee]["name"] + "\n" + spl.attrib["memo"]
-            else:
-                splits[0].attrib["payee"] = rev_payees[payee_replacement]
-                if splits[0].attrib["memo"] == "":
-                    splits[0].attrib["memo"] = payees[curr_payee]["name"]
+def read_payee_rules(rulesfile):
+    # Every line of a rules file is "<pattern> => <replacement payee>", empty lines
+    # and lines starting with "#" are skipped
+    rules = []
+    with open(rulesfile, encoding="UTF-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if (line == "") or line.startswith("#"):
+                continue
+            payee_pattern, sep, payee_replacement = line.rpartition(" => ")
+            if (sep == "") or (payee_pattern.strip() == "") or (payee_replacement.strip() == ""):
+                print(f"Line {line_no} of payee rules file {rulesfile} is not \"<pattern> => <payee>\".")
+                return None
+            try:
+                re.compile(payee_pattern.strip())
+            except re.error as err:
+                print(f"Line {line_no} of payee rules file {rulesfile} has an invalid pattern: {err}.")
+                return None
+            rules.append((payee_pattern.strip(), payee_replacement.strip()))
+    return rules
+
+
+def match_payees(payees, rules, rev_payees):
+    # Every payee is matched against the rules once, the first matching rule wins.
+    # Returns a dictionary mapping IDs of matching payees to IDs of their replacements.
+    compiled_rules = [(re.compile(payee_pattern), rev_payees[payee_replacement])
+                      for payee_pattern, payee_replacement in rules]
+    replacements = dict()
+    for payee_id, payee in payees.items():
+        for payee_pattern, replacement_id in compiled_rules:
+            if payee_pattern.match(payee.name):
+                replacements[payee_id] = replacement_id
+                break
+    return replacements
+
+
+def replace_payee(item, splits, split_tags, state, opts):
+    payees = state["payees"]
+    payee_replacements = state["payee_replacements"]
+    curr_payee = splits[0].payee
+    if curr_payee in payee_replacements:
+        if len(splits) == 2:
+            for spl in splits:
+                spl.payee = payee_replacements[curr_payee]
+                if spl.memo == "":
+                    spl.memo = payees[curr_payee].name
                 else:
-                    splits[0].attrib["memo"] = payees[curr_payee]["name"] + "\n" + spl.attrib["memo"]
+                    spl.memo = payees[curr_payee].name + "\n" + spl.memo
+        else:
+            splits[0].payee = payee_replacements[curr_payee]
+            if splits[0].memo == "":
+                splits[0].memo = payees[curr_payee].name
+            else:
+                splits[0].memo = payees[curr_payee].name + "\n" + splits[0].memo
     return
 
 
+# Transaction fixers in the order they are applied. Each fixer works on a single transaction
+# and is enabled by its option key. All enabled fixers are applied to a transaction before
+# moving on to the next one, so transactions are traversed only once.
+TRANSACTION_FIXERS = [
+    ("split_type", find_mismatches_in_slits),
+    ("to_erase_number", erase_number),
+    ("reconcile_flag", fix_reconcile_flag),
+    ("set_txn_numbers_flag", assign_txn_numbers),
+    ("to_add_default_tag", add_default_tag),
+    ("set_replace_tag_in_account_flag", replace_tag_in_account),
+    ("set_move_split_lvl_tag_to_txn_lvl", move_tag_from_split_level_to_txn_level),
+    ("to_reorder_tags", reorder_tags_in_txn),
+    ("to_replace_payee", replace_payee),
+]
+
+# Fixers which need the sets of tag IDs of splits
+TAG_FIXERS = [add_default_tag, replace_tag_in_account, move_tag_from_split_level_to_txn_level]
+
+# Fixers which depend only on the transaction itself, mapped to the options and the values derived
+# from lookup tables (keys of the state, see "prepare_fixers") they depend on. Transactions are
+# cached only if all applied fixers are cacheable.
+CACHEABLE_FIXERS = {
+    erase_number: ((), ()),
+    fix_reconcile_flag: (("reconcile_flag",), ()),
+    add_default_tag: (("default_tag", "excluded_tags"), ("account_index", "default_tag_id", "excluded_tag_ids")),
+    replace_tag_in_account: (("replace_target_account", "old_tag", "new_tag"),
+                             ("replace_target_acnt_id", "old_tag_id", "new_tag_id")),
+    move_tag_from_split_level_to_txn_level: (("tag_to_move",), ("account_index", "tag_to_move_id")),
+    reorder_tags_in_txn: ((), ("rev_tags",)),
+    replace_payee: (("payee_rules",), ("payee_replacements",)),
+}
+
+# Sections of the file (upper case) every operation modifies and lookup tables (lower case) it needs.
+# Only the lookup tables needed by the requested operations are built. Sections which are neither
+# modified nor needed for lookup tables are copied to the output without being parsed.
+OPERATION_NEEDS = {
+    "split_type": {"TRANSACTIONS", "accounts", "account_index", "payees"},
+    "to_erase_number": {"TRANSACTIONS"},
+    "reconcile_flag": {"TRANSACTIONS"},
+    "set_txn_numbers_flag": {"TRANSACTIONS", "account_index"},
+    "to_add_default_tag": {"TRANSACTIONS", "account_index", "tags"},
+    "set_replace_tag_in_account_flag": {"TRANSACTIONS", "account_index", "tags"},
+    "set_move_split_lvl_tag_to_txn_lvl": {"TRANSACTIONS", "account_index", "tags"},
+    "to_reorder_tags": {"TRANSACTIONS", "tags"},
+    "to_replace_payee": {"TRANSACTIONS", "PAYEES", "payees"},
+    "set_expenses_currency_flag": {"ACCOUNTS", "account_index"},
+    "to_report": {"TRANSACTIONS", "accounts", "account_index", "payees", "tags"},
+    "to_validate": {"accounts", "payees", "tags"},
+}
+
+
+# Sections lookup tables are built from
+TABLE_SECTIONS = {"accounts": "ACCOUNTS", "payees": "PAYEES", "tags": "TAGS"}
+
+
+def execution_plan(opts):
+    # Set of sections and lookup tables needed by the requested operations
+    needs = set()
+    for key, k in OPERATION_NEEDS.items():
+        if key in opts:
+            needs |= k
+    if "account_index" in needs:
+        needs.add("accounts")
+    return needs
+
+
 def print_help():
     print(
-        f"python3 {sys.argv[0]} [options/flags] [-o <outputfile>] <inputfile>.xml\n"
+        f"python3 {sys.argv[0]} [options/flags] [-o <outputfile>] <inputfile>.kmy|xml [<inputfile> ...]\n"
     )
     print(
         'Input arguments:\n\
     -o --output                          Output file, if not specified, output file is set to\n\
-                                         "<input file>_fixed.xml". Input file should always be a KMyMoney XML file.\n\
+                                         "<input file>_fixed.<ext>". Input file should always be a KMyMoney file,\n\
+                                         either gzip-compressed (*.kmy) or plain XML. Output file is compressed\n\
+                                         if its extension is ".kmy" or ".gz".\n\
+    -z --compression-level <level>       Compress output file with given gzip compression <level> (0-9) regardless\n\
+                                         of its extension. Level 6 is used by default for compressed output.\n\
     -e --erase-txn-numbers               Erase all transaction numbers (i.e. "number" attribute in a split).\n\
     -n --assign-txn-numbers              Assign integer values to all transactions in an account\n\
                                          sorted in chronological order by "post date". The earliest transaction\n\
                                          is assigned number 1, the ones following it will have numbers incremented\n\
-                                         by one. Iterate over all asset accounts.\n\
+                                         by one. Transactions with the same "post date" keep their order in the file.\n\
+                                         Iterate over all asset accounts including sub-accounts. In streaming mode,\n\
+                                         transactions are read in a separate pass beforehand.\n\
     -s --fix-splits-with-count <count>   If <count> is 2, then fix empty payee for the second split in a transaction\n\
                                          with 2 splits by assigning the payee from the first split.\n\
                                          If <count> is 1, then display transactions with a single split.\n\
@@ -315,19 +771,1982 @@ def print_help():
                                          "ExtraHousehold". Account name should a substring of the full account name.\n\
     -m --move-split-lvl-tag-to-txn-lvl   Move tag from split level to transaction level if all splits in a the\n\
                                          transaction have this tag assigned. Erase the tag at split level.\n\
-    -c --set-expenses-currency <curr>    Set all expense accounts\' currency to <curr>. \n\
+    -c --set-expenses-currency <curr>    Set all expense accounts\' currency to <curr>. If no other given option\n\
+                                         works on transactions, they are copied to the output without being parsed.\n\
     -t --reorder-tags                    Reorder tags in transactions alphabetically.\n\
+    -p --payee-pattern <regex>           Replace the payee of transactions whose payee name matches <regex> (matched\n\
+                                         at the beginning of the name) with the payee given by "-u". The original\n\
+                                         payee name is prepended to the memo. The new payee is created if needed.\n\
+    -u --payee-replacement <payee>       Payee for replacement used with "-p".\n\
+    -R --payee-rules <file>              Replace payees according to a rules file with one "<regex> => <payee>" rule\n\
+                                         per line (lines starting with "#" are skipped). The first matching rule\n\
+                                         is applied, the rule given by "-p" and "-u" is checked first.\n\
+    -S --stream                          Process the file in streaming mode: every transaction is fixed and written\n\
+                                         out as soon as it is parsed, so memory usage does not grow with the number\n\
+                                         of transactions. Unmodified sections are written out anew instead of being\n\
+                                         copied as they are, otherwise output is identical to the default mode.\n\
+    -j --jobs <count>                    Process transactions in parallel by <count> worker processes. Transactions are\n\
+                                         split into chunks which are fixed by the workers and written out in their\n\
+                                         original order, so the output is identical to the default mode. Compressed\n\
+                                         files are decompressed into memory. Ignored when several files are given.\n\
+    -P --profile                         Measure wall time, memory allocated (traced by tracemalloc) and number of\n\
+                                         processed items for every stage (parsing, lookup tables, every fixer,\n\
+                                         output), print a summary and write a JSON report to\n\
+                                         "<output file>.profile.json".\n\
+       --cache                           Keep a cache of fixed transactions in "<input file>.cache" (SQLite database).\n\
+                                         Transactions which are unchanged since the last run with the same fixers and\n\
+                                         options are copied to the output without being parsed. The cache is not used\n\
+                                         with fixers which depend on other transactions ("-n") or report on them ("-s")\n\
+                                         and in streaming mode ("-S").\n\
+       --no-cache                        Do not use the cache even if "--cache" is given.\n\
+       --rebuild-cache                   Discard the cached transactions and fill the cache anew.\n\
+       --dry-run --diff                  Do not write the fixed file, write the changes fixers would make to a change log\n\
+                                         in JSON lines format instead ("-o" names the log, by default\n\
+                                         "<input file>_changes.jsonl"). Every line holds the changes of a transaction,\n\
+                                         account or payee: changed attributes and tags of splits with their old and new\n\
+                                         values and the fixer which made them. The log is not written if nothing would\n\
+                                         be changed. Transactions are processed in streaming mode.\n\
+    -w --workers <count>                 Number of worker processes used when several input files, a directory\n\
+                                         or a glob pattern are given (by default, the number of CPUs). In this batch\n\
+                                         mode every file is processed with the same options, "-o" names the output\n\
+                                         directory, reports are printed per file followed by a summary. Exit code\n\
+                                         is non-zero if any file failed.\n\
+       --report                          Read-only report mode: write one row per split with columns txn_id, postdate,\n\
+                                         account (full name), account_type, payee, tags, amount (exact, value times\n\
+                                         price) and currency (of the account) to the output file, by default\n\
+                                         "<input file>_report.csv". Output is written in Parquet or Arrow format\n\
+                                         if the output file has extension ".parquet" or ".arrow"/".feather"\n\
+                                         (requires pyarrow), in CSV format otherwise. In Parquet/Arrow output postdate\n\
+                                         is a date and amount a decimal with 12 decimal places (rounded if longer).\n\
+                                         Fixing options are ignored.\n\
+       --account <acnt>                  Report only splits of accounts whose full name contains <acnt>.\n\
+       --from <date>                     Report only transactions posted on or after <date> (YYYY-MM-DD).\n\
+       --to <date>                       Report only transactions posted on or before <date> (YYYY-MM-DD).\n\
+       --tag <tag>                       Report only splits possessing <tag>.\n\
+       --validate                        Read-only validation mode: check that values of splits of every transaction\n\
+                                         sum to zero, that the value of every split equals its shares times price\n\
+                                         (rounded to the denominator of the value) and that all accounts, payees, tags\n\
+                                         and parent accounts referenced in the file exist. Problems are printed together\n\
+                                         with the closing balance of every account. Running balances (in shares) of all\n\
+                                         accounts are written in chronological order to the output file, by default\n\
+                                         "<input file>_balances.csv". Amounts are summed in NumPy arrays if NumPy is\n\
+                                         installed. Exit code is non-zero if any check failed. Fixing options are ignored.\n\
     -h --help                            Print this help message.\
     '
     )
     return
 
 
+def find_tag_id(tags, tag_name):
+    if tag_name not in tags.keys():
+        print(f"Tag {tag_name} was not found in the provided XML file.")
+        return None
+    return tags[tag_name]
+
+
+def prepare_fixers(root, opts, profiler=None, transactions=None, cache=None):
+    # Build lookup tables and apply fixers which touch sections preceding TRANSACTIONS.
+    # "root" may hold only these sections when the file is processed in streaming mode or
+    # in parallel, then "transactions" iterates over post dates and account IDs of splits
+    # of all transactions (see "txn_split_accounts") obtained in a separate pass.
+    # Only the lookup tables needed by the requested operations are built.
+    needs = execution_plan(opts)
+
+    # ============== ACCOUNTS ===================
+    accounts = dict()
+    if "accounts" in needs:
+        for k in root.findall("./ACCOUNTS/ACCOUNT"):
+            acnt = Account(k)
+            accounts[acnt.id] = acnt
+
+    # ============== PAYEES =====================
+    payees = dict()
+    if "payees" in needs:
+        for k in root.findall("./PAYEES/PAYEE"):
+            payee = Payee(k)
+            payees[payee.id] = payee
+
+    # ================ TAGS =====================
+    tags = dict()
+    tag_ids = dict()
+    if "tags" in needs:
+        for k in root.findall("./TAGS/TAG"):
+            tag = Tag(k)
+            tags[tag.id] = tag
+            tag_ids[tag.name] = tag.id
+
+    acnt_index = None
+    if "account_index" in needs:
+        with profile_stage(profiler, "account index", len(accounts)):
+            acnt_index = AccountIndex(accounts)
+
+    state = {"accounts": accounts, "account_index": acnt_index, "payees": payees, "tags": tags, "tag_ids": tag_ids}
+    state["needs"] = needs
+    state["cnt_all"] = 0
+    state["cnt_emp"] = 0
+    state["pipeline"] = [fixer for key, fixer in TRANSACTION_FIXERS if key in opts]
+    state["track_tags"] = any(fixer in TAG_FIXERS for fixer in state["pipeline"])
+    state["cache"] = None
+    # Changes made by fixers are collected in dry-run mode
+    state["changes"] = [] if "to_diff" in opts else None
+    state["fixer_names"] = [fixer.__name__ for fixer in state["pipeline"]]
+    if profiler is not None:
+        state["pipeline"] = [profiler.wrap(fixer.__name__, fixer) for fixer in state["pipeline"]]
+
+    if "set_txn_numbers_flag" in opts:
+        # All accounts in the hierarchy of assets, not only top-level ones. They are found
+        # by the ID of the top-level asset account, so that renamed accounts do not matter.
+        asset_ids = [acnt_id for acnt_id in accounts
+                     if (acnt_index.top_id[acnt_id] == "AStd::Asset") and (acnt_id != "AStd::Asset")]
+        if transactions is None:
+            transactions = txn_split_accounts(map(Transaction, root.iterfind("./TRANSACTIONS/TRANSACTION")))
+        with profile_stage(profiler, "transaction numbers"):
+            state["txn_numbers"] = number_splits_chronologically(transactions, asset_ids)
+        state["txn_position"] = 0
+
+    if "set_expenses_currency_flag" in opts:
+        for k in root.findall("./ACCOUNTS/ACCOUNT"):
+            acnt = accounts[k.attrib["id"]]
+            if acnt_index.full_name[acnt.id].startswith("Expenses:"):
+                if (state["changes"] is not None) and (acnt.currency != opts["expenses_currency"]):
+                    state["changes"].append({"account": acnt.id, "changes": [
+                        {"attribute": "currency", "old": acnt.currency, "new": opts["expenses_currency"]}]})
+                k.attrib["currency"] = opts["expenses_currency"]
+                acnt.currency = opts["expenses_currency"]
+
+    if "set_replace_tag_in_account_flag" in opts:
+        state["replace_target_acnt_id"] = acnt_index.find_by_substring(opts["replace_target_account"])
+        if state["replace_target_acnt_id"] is None:
+            print(f"Account {opts['replace_target_account']} was not found in the provided XML file.")
+
+    if "to_add_default_tag" in opts:
+        state["default_tag_id"] = find_tag_id(tag_ids, opts["default_tag"])
+        # Excluded tags missing in the file cannot be assigned to any split
+        excluded_tags_ext = opts["excluded_tags"] + [opts["default_tag"]]
+        state["excluded_tag_ids"] = {tag_ids[k] for k in excluded_tags_ext if k in tag_ids.keys()}
+
+    if "set_replace_tag_in_account_flag" in opts:
+        state["old_tag_id"] = find_tag_id(tag_ids, opts["old_tag"])
+        state["new_tag_id"] = find_tag_id(tag_ids, opts["new_tag"])
+        if (state["old_tag_id"] is None) or (state["new_tag_id"] is None):
+            state["replace_target_acnt_id"] = None
+
+    if "set_move_split_lvl_tag_to_txn_lvl" in opts:
+        state["tag_to_move_id"] = find_tag_id(tag_ids, opts["tag_to_move"])
+
+    if "to_reorder_tags" in opts:
+        state["rev_tags"] = {tag.id: tag.name for tag in tags.values()}
+
+    if "to_replace_payee" in opts:
+        rev_payees = {payee.name: payee.id for payee in payees.values()}
+
+        # Find the largest payee ID in the dictionary and 1 to it
+        next_payee_no = int(sorted(payees.keys())[-1][1:]) + 1 if len(payees) > 0 else 1
+        new_payees = []
+        for payee_pattern, payee_for_replacement in opts["payee_rules"]:
+            if payee_for_replacement in rev_payees.keys():
+                continue
+            id_payee_for_replacement = f"P{next_payee_no}"
+            next_payee_no += 1
+            d = ET.SubElement(root.findall("./PAYEES")[0], "PAYEE")
+            d.attrib["id"] = id_payee_for_replacement
+            d.attrib["name"] = payee_for_replacement
+            d.attrib["email"] = ""
+            d.attrib["reference"] = ""
+            d.attrib["matchingenabled"] = ""
+            a = ET.SubElement(d, "ADDRESS")
+            a.attrib["telephone"] = ""
+            a.attrib["state"] = ""
+            a.attrib["city"] = ""
+            a.attrib["street"] = ""
+            a.attrib["postcode"] = ""
+            rev_payees[payee_for_replacement] = id_payee_for_replacement
+            new_payees.append(Payee(d))
+            if state["changes"] is not None:
+                state["changes"].append({"payee": id_payee_for_replacement, "changes": [
+                    {"element": "PAYEE", "old": None, "new": payee_for_replacement}]})
+        state["payee_replacements"] = match_payees(payees, opts["payee_rules"], rev_payees)
+        for payee in new_payees:
+            payees[payee.id] = payee
+
+    if cache is not None:
+        # Fixers are known only now, the cache is used only if all of them are cacheable
+        fingerprint = cache_fingerprint(state, opts)
+        if fingerprint is None:
+            if len(state["pipeline"]) > 0:
+                print("Cache is not used with fixers which depend on other transactions (\"-n\", \"-s\").")
+            cache.close()
+        else:
+            cache.load(fingerprint)
+            state["cache"] = cache
+    return state
+
+
+def apply_transaction_fixers(transactions, state, opts):
+    pipeline = state["pipeline"]
+    track_tags = state["track_tags"]
+    split_tags = None
+    for item in transactions:
+        # Splits and their tags are looked up once and shared by all fixers
+        splits = item.splits
+        if track_tags:
+            split_tags = [split_tag_ids(spl) for spl in splits]
+        if state["changes"] is not None:
+            # Changes are found by comparing the transaction before and after every fixer
+            txn_changes = []
+            before = transaction_snapshot(item)
+            for fixer, fixer_name in zip(pipeline, state["fixer_names"]):
+                fixer(item, splits, split_tags, state, opts)
+                after = transaction_snapshot(item)
+                txn_changes.extend(snapshot_changes(fixer_name, before, after))
+                before = after
+            if len(txn_changes) > 0:
+                state["changes"].append({"txn": item.id, "postdate": item.postdate, "changes": txn_changes})
+            continue
+        for fixer in pipeline:
+            fixer(item, splits, split_tags, state, opts)
+    return
+
+
+def finish_fixers(state, opts):
+    if "split_type" in opts:
+        print_split_counts(opts["split_type"], state["cnt_all"], state["cnt_emp"])
+    if state["cache"] is not None:
+        state["cache"].close()
+    return
+
+
+# ============== PROFILING ==================
+class Profiler:
+    # Wall time, memory allocated (as traced by tracemalloc) and number of items processed
+    # per stage. Stages may be nested, e.g. every fixer is a stage within the "fixers" stage,
+    # and a stage entered several times accumulates its measurements.
+    def __init__(self):
+        self.stages = dict()
+        self.open_stages = []
+        self.peak = 0
+        tracemalloc.start()
+        self.start = time.perf_counter()
+
+    def fold_peak(self):
+        # Peak of traced memory is reset when a stage begins, so it is passed on
+        # to all enclosing stages beforehand
+        peak = tracemalloc.get_traced_memory()[1]
+        self.peak = max(self.peak, peak)
+        for k in self.open_stages:
+            k["peak"] = max(k["peak"], peak)
+        return
+
+    def begin(self, name):
+        if name not in self.stages:
+            parent = self.open_stages[-1]["name"] if len(self.open_stages) > 0 else None
+            self.stages[name] = {
+                "name": name,
+                "parent": parent,
+                "calls": 0,
+                "items": 0,
+                "seconds": 0.0,
+                "allocated_bytes": 0,
+                "peak_bytes": 0,
+            }
+        self.fold_peak()
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        self.open_stages.append({"name": name, "memory": current, "peak": current, "start": time.perf_counter()})
+        return
+
+    def end(self, items=0):
+        t = time.perf_counter()
+        current = tracemalloc.get_traced_memory()[0]
+        self.fold_peak()
+        k = self.open_stages.pop()
+        stage = self.stages[k["name"]]
+        stage["calls"] += 1
+        stage["items"] += items
+        stage["seconds"] += t - k["start"]
+        stage["allocated_bytes"] += current - k["memory"]
+        stage["peak_bytes"] = max(stage["peak_bytes"], k["peak"] - k["memory"])
+        return
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(items)
+
+    def wrap(self, name, func, items=1):
+        # Function measured as a stage every time it is called
+        def profiled_func(*args, **kwargs):
+            self.begin(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.end(items)
+
+        return profiled_func
+
+    def remainder(self, name, parent):
+        # Measurements of the parent stage not accounted for by its sub-stages are recorded
+        # as a separate sub-stage, e.g. parsing interleaved with fixing and writing in streaming mode
+        total = self.stages[parent]
+        children = [k for k in self.stages.values() if k["parent"] == parent]
+        self.stages[name] = {
+            "name": name,
+            "parent": parent,
+            "calls": total["calls"],
+            "items": total["items"],
+            "seconds": total["seconds"] - sum(k["seconds"] for k in children),
+            "allocated_bytes": total["allocated_bytes"] - sum(k["allocated_bytes"] for k in children),
+            "peak_bytes": total["peak_bytes"],
+        }
+        return
+
+    def set_items(self, name, items):
+        if name in self.stages:
+            self.stages[name]["items"] = items
+        return
+
+    def report(self):
+        self.fold_peak()
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "peak_bytes": self.peak,
+            "stages": list(self.stages.values()),
+        }
+
+    def print_summary(self, report):
+        print("============== PROFILE ====================")
+        print(f"{'Stage':<44} {'Time, s':>9} {'Alloc, MiB':>11} {'Peak, MiB':>10} {'Items':>10} {'Items/s':>10}")
+        for stage in report["stages"]:
+            depth = 0
+            parent = stage["parent"]
+            while parent is not None:
+                depth += 1
+                parent = self.stages[parent]["parent"]
+            name = f"{'  ' * depth}{stage['name']}"
+            rate = f"{stage['items'] / stage['seconds']:10.0f}" if stage["seconds"] > 0 else f"{'-':>10}"
+            print(
+                f"{name:<44} {stage['seconds']:9.3f} {stage['allocated_bytes'] / 2**20:11.1f} "
+                f"{stage['peak_bytes'] / 2**20:10.1f} {stage['items']:10d} {rate}"
+            )
+        print(f"{'Total':<44} {report['seconds']:9.3f} {'':>11} {report['peak_bytes'] / 2**20:10.1f}")
+        return
+
+    def finish(self, reportfile):
+        # Print a summary and write a JSON report
+        report = self.report()
+        tracemalloc.stop()
+        self.print_summary(report)
+        with open(reportfile, "w", encoding="UTF-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Profile report: {reportfile}")
+        return
+
+
+def profile_stage(profiler, name, items=0):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, items)
+
+
+# ============== CACHE ======================
+def transaction_hash(data):
+    # Content hash of a transaction as it is read from the input, without its tail
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class TransactionCache:
+    # Sidecar SQLite database mapping the content hash of a transaction read from the input to the
+    # transaction written out for it by the last run with the same fixers, options and lookup tables
+    # (see "cache_fingerprint"), or to "" if the fixers left it unchanged. Such transactions are copied
+    # to the output without being parsed. Entries of transactions which are no longer in the input are
+    # removed, entries of other fingerprints are kept. Only hashes are kept in memory, written out
+    # transactions are looked up one by one.
+    def __init__(self, cachefile, rebuild=False):
+        self.db = sqlite3.connect(cachefile)
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs (fingerprint TEXT, hash BLOB, text TEXT, "
+                        "PRIMARY KEY (fingerprint, hash))")
+        if rebuild:
+            self.db.execute("DELETE FROM outputs")
+        self.fingerprint = None
+        # Maps a hash to True if the transaction is written out unchanged
+        self.entries = dict()
+        self.seen = set()
+        self.updates = []
+        self.cnt_all = 0
+        self.cnt_hit = 0
+
+    def load(self, fingerprint):
+        self.fingerprint = fingerprint
+        query = "SELECT hash, length(text) = 0 FROM outputs WHERE fingerprint = ?"
+        self.entries = {txn_hash: bool(unchanged) for txn_hash, unchanged in self.db.execute(query, (fingerprint,))}
+        return
+
+    def get(self, txn_hash):
+        # Output of a transaction with given content hash, None if it is not known
+        # or the transaction cannot be cached (hash is None)
+        self.cnt_all += 1
+        if txn_hash is None:
+            return None
+        self.seen.add(txn_hash)
+        unchanged = self.entries.get(txn_hash)
+        if unchanged is None:
+            return None
+        self.cnt_hit += 1
+        if unchanged:
+            return ""
+        query = "SELECT text FROM outputs WHERE fingerprint = ? AND hash = ?"
+        return self.db.execute(query, (self.fingerprint, txn_hash)).fetchone()[0]
+
+    def record(self, txn_hash, text, batch_size=8192):
+        # Updates are written to the database in batches, so that they are not kept in memory
+        self.updates.append((self.fingerprint, txn_hash, text))
+        if len(self.updates) >= batch_size:
+            self.write_updates()
+        return
+
+    def write_updates(self):
+        self.db.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)", self.updates)
+        self.updates = []
+        return
+
+    def close(self):
+        if self.fingerprint is not None:
+            stale = [(self.fingerprint, k) for k in self.entries if k not in self.seen]
+            self.db.executemany("DELETE FROM outputs WHERE fingerprint = ? AND hash = ?", stale)
+            self.write_updates()
+            self.db.commit()
+            print(f"Cache: {self.cnt_hit} of {self.cnt_all} transactions were copied without being parsed.")
+        self.db.close()
+        return
+
+
+def state_value(state, key):
+    # Value derived from lookup tables whose representation does not depend on the order of items
+    value = state.get(key)
+    if key == "account_index":
+        return sorted(acnt_id for acnt_id, is_inc_exp in value.is_inc_exp.items() if is_inc_exp)
+    if key == "payee_replacements":
+        # Names of replaced payees are prepended to memos
+        return sorted((k, state["payees"][k].name, v) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, dict):
+        return sorted(value.items())
+    return value
+
+
+def cache_fingerprint(state, opts):
+    # Hash of the names of applied fixers together with the values of the options and lookup tables
+    # they depend on. Returns None if no fixer is applied or some fixer depends on other transactions.
+    parts = []
+    for key, fixer in TRANSACTION_FIXERS:
+        if key not in opts:
+            continue
+        if fixer not in CACHEABLE_FIXERS:
+            return None
+        option_keys, state_keys = CACHEABLE_FIXERS[fixer]
+        values = [opts.get(k) for k in option_keys] + [state_value(state, k) for k in state_keys]
+        parts.append(f"{fixer.__name__}{values!r}")
+    if len(parts) == 0:
+        return None
+    return hashlib.blake2b("\n".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def open_cache(inputfile, opts):
+    # Cache of an input file is stored next to it
+    if ("to_cache" not in opts) or ("no_cache" in opts) or ("to_diff" in opts):
+        return None
+    if "to_stream" in opts:
+        print("Cache is not used in streaming mode.")
+        return None
+    return TransactionCache(f"{inputfile}.cache", "rebuild_cache" in opts)
+
+
+# ============== FILE ACCESS ================
+# KMyMoney stores its files as gzip-compressed XML
+GZIP_MAGIC = b"\x1f\x8b"
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def open_input(inputfile):
+    # Gzip-compressed files are decompressed on the fly, plain XML files are read as they are
+    with open(inputfile, "rb") as f:
+        magic = f.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(inputfile, "rb")
+    return open(inputfile, "rb")
+
+
+@contextlib.contextmanager
+def map_input(inputfile):
+    # Plain XML files are memory-mapped, gzip-compressed files are decompressed into memory
+    with open_input(inputfile) as f_in:
+        if isinstance(f_in, gzip.GzipFile) or (os.fstat(f_in.fileno()).st_size == 0):
+            yield f_in.read()
+        else:
+            with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def output_compress_level(outputfile, compress_level=None):
+    # Output is compressed if a compression level is given or if the output file
+    # has a KMyMoney (*.kmy) or gzip (*.gz) extension
+    if (compress_level is None) and outputfile.endswith((".kmy", ".gz")):
+        compress_level = DEFAULT_COMPRESS_LEVEL
+    return compress_level
+
+
+def open_output(outputfile, compress_level=None):
+    # Output is compressed on the fly, see "output_compress_level"
+    compress_level = output_compress_level(outputfile, compress_level)
+    if compress_level is not None:
+        return gzip.open(outputfile, "wt", encoding="UTF-8", compresslevel=compress_level)
+    return open(outputfile, "w", encoding="UTF-8")
+
+
+def wrap_output(f, name, compress_level=None):
+    # Text stream writing to a binary file, compressed with "name" stored in the gzip header
+    if compress_level is not None:
+        f = gzip.GzipFile(filename=name, mode="wb", compresslevel=compress_level, fileobj=f)
+    return io.TextIOWrapper(f, encoding="UTF-8")
+
+
+@contextlib.contextmanager
+def replace_output(outputfile, compress_level=None):
+    # Output is written to a temporary file in the directory of the output file, which replaces
+    # the output file only once it is complete. Input is read while output is written, so the input
+    # file may be given as the output file, and the output file is left as it was if processing fails.
+    compress_level = output_compress_level(outputfile, compress_level)
+    if os.path.exists(outputfile) and not os.path.isfile(outputfile):
+        # Devices (e.g. /dev/null) and pipes are written directly
+        with open_output(outputfile, compress_level) as f:
+            yield f
+        return
+    name = os.path.basename(outputfile)
+    outputfile = os.path.realpath(outputfile)
+    tmpfile = f"{outputfile}.{os.getpid()}.tmp"
+    try:
+        # Gzip header holds the name of the output file, not the temporary one
+        with open(tmpfile, "wb") as f_tmp, wrap_output(f_tmp, name, compress_level) as f:
+            yield f
+        if os.path.exists(outputfile):
+            os.chmod(tmpfile, os.stat(outputfile).st_mode & 0o7777)
+        os.replace(tmpfile, outputfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return
+
+
+# ============== OUTPUT FORMATTING ==========
+DOC_TYPE = '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE KMYMONEY-FILE>\n'
+
+
+def escape_attrib(text):
+    # Attribute values are escaped the way KMyMoney does it: ">" is kept as it is,
+    # line feeds and tabs are written as hexadecimal character references
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#xa;")
+    if "\t" in text:
+        text = text.replace("\t", "&#x9;")
+    return text
+
+
+def escape_text(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    return text
+
+
+def text_before_tag(text):
+    # Text or tail of an element, which is always followed by a tag.
+    # Tags which would end up on the same line are divided with a line break.
+    if not text:
+        return "\n"
+    text = escape_text(text)
+    if text[-1] == ">":
+        return f"{text}\n"
+    return text
+
+
+class KMyMoneyWriter:
+    # Writes a document formatted the way KMyMoney does it: elements without content are closed
+    # with "/>" and every tag starts on a new line unless it is preceded by text.
+    # Serialized pieces are collected and written out to the file in large blocks.
+    def __init__(self, f, max_parts=8192):
+        self.f = f
+        self.parts = []
+        self.max_parts = max_parts
+
+    def flush(self):
+        self.f.write("".join(self.parts))
+        self.parts.clear()
+        return
+
+    def start(self, elem):
+        attrs = "".join([f' {k}="{escape_attrib(v)}"' for k, v in elem.items()])
+        self.parts.append(f"<{elem.tag}{attrs}>")
+        return
+
+    def text(self, text):
+        self.parts.append(text_before_tag(text))
+        return
+
+    def serialized(self, text):
+        # Elements already serialized by another writer
+        self.parts.append(text)
+        return
+
+    def raw(self, data, start, end, block_size=2**20):
+        # Byte range of the input copied as it is, in blocks
+        self.flush()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for k in range(start, end, block_size):
+            self.f.write(decoder.decode(data[k:min(k + block_size, end)]))
+        self.f.write(decoder.decode(b"", final=True))
+        return
+
+    def end(self, elem):
+        self.parts.append(f"</{elem.tag}>")
+        return
+
+    def element(self, elem, with_tail=True):
+        self.serialize(elem)
+        if with_tail:
+            self.parts.append(text_before_tag(elem.tail))
+        return
+
+    def serialize(self, elem):
+        append = self.parts.append
+        tag = elem.tag
+        attrs = "".join([f' {k}="{escape_attrib(v)}"' for k, v in elem.items()])
+        if elem.text or len(elem):
+            append(f"<{tag}{attrs}>")
+            append(text_before_tag(elem.text))
+            for child in elem:
+                self.serialize(child)
+                append(text_before_tag(child.tail))
+                if len(self.parts) >= self.max_parts:
+                    self.flush()
+            append(f"</{tag}>")
+        elif attrs:
+            append(f"<{tag}{attrs}/>")
+        else:
+            append(f"<{tag} />")
+        return
+
+    def split(self, spl):
+        append = self.parts.append
+        attrs = "".join([f' {k}="{escape_attrib(v)}"' for k, v in spl.items()])
+        if spl.text or spl.children:
+            append(f"<SPLIT{attrs}>")
+            append(text_before_tag(spl.text))
+            for child, tail in zip(spl.children or (), spl.tails or ()):
+                if type(child) is str:
+                    append(f'<TAG id="{escape_attrib(child)}"/>')
+                else:
+                    self.serialize(child)
+                append(text_before_tag(tail))
+            append("</SPLIT>")
+        elif attrs:
+            append(f"<SPLIT{attrs}/>")
+        else:
+            append("<SPLIT />")
+        return
+
+    def transaction(self, txn, with_tail=True):
+        # Transaction of the model, written out exactly as an element read from the file
+        append = self.parts.append
+        attrs = "".join([f' {k}="{escape_attrib(v)}"' for k, v in txn.items()])
+        if txn.text or txn.children:
+            append(f"<TRANSACTION{attrs}>")
+            append(text_before_tag(txn.text))
+            for child, tail in zip(txn.children, txn.tails):
+                if child is not txn.splits:
+                    self.serialize(child)
+                elif txn.splits_text or txn.splits:
+                    append("<SPLITS>")
+                    append(text_before_tag(txn.splits_text))
+                    for spl in txn.splits:
+                        self.split(spl)
+                        append(text_before_tag(spl.tail))
+                    append("</SPLITS>")
+                else:
+                    append("<SPLITS />")
+                append(text_before_tag(tail))
+            append("</TRANSACTION>")
+        elif attrs:
+            append(f"<TRANSACTION{attrs}/>")
+        else:
+            append("<TRANSACTION />")
+        if with_tail:
+            append(text_before_tag(txn.tail))
+        if len(self.parts) >= self.max_parts:
+            self.flush()
+        return
+
+    def transactions(self, txns_elem, transactions):
+        # TRANSACTIONS section whose transactions were loaded into the model
+        if txns_elem.text or transactions:
+            self.start(txns_elem)
+            self.text(txns_elem.text)
+            for txn in transactions:
+                self.transaction(txn)
+            self.end(txns_elem)
+        else:
+            self.serialize(txns_elem)
+        return
+
+    def header(self):
+        self.parts.append(DOC_TYPE)
+        return
+
+    def footer(self, root):
+        self.parts.append(escape_text(root.tail or ""))
+        self.parts.append("\n")
+        self.flush()
+        return
+
+    def document(self, root, transactions=None):
+        # "transactions" of the model take the place of the first TRANSACTIONS section
+        self.header()
+        txns_elem = root.find("./TRANSACTIONS") if transactions is not None else None
+        if txns_elem is None:
+            self.element(root, with_tail=False)
+        else:
+            self.start(root)
+            self.text(root.text)
+            for section in root:
+                if section is txns_elem:
+                    self.transactions(txns_elem, transactions)
+                    self.text(txns_elem.tail)
+                else:
+                    self.element(section)
+            self.end(root)
+        self.footer(root)
+        return
+
+
+def write_output(root, outputfile, compress_level=None, transactions=None):
+    with open_output(outputfile, compress_level) as f:
+        KMyMoneyWriter(f).document(root, transactions)
+    return
+
+
+# ============== STREAMING ==================
+def iter_transactions(inputfile, on_transactions=None):
+    # Separate pass over transactions of a file, e.g. for fixers which need all of them in advance.
+    # "on_transactions" is called with the root holding all sections preceding TRANSACTIONS.
+    # Every transaction is discarded once it is processed.
+    depth = 0
+    section = None
+    with open_input(inputfile) as f_in:
+        parser = ET.XMLParser(encoding="utf-8")
+        for event, elem in ET.iterparse(f_in, events=("start", "end"), parser=parser):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2:
+                    section = elem
+                    if elem.tag == "TRANSACTIONS":
+                        if on_transactions is not None:
+                            on_transactions(root)
+                        # The parser may run ahead of the events, so stop at TRANSACTIONS
+                        for prev_section in root:
+                            if prev_section is elem:
+                                break
+                            prev_section.clear()
+            else:
+                if (depth == 3) and (elem.tag == "TRANSACTION") and (section.tag == "TRANSACTIONS"):
+                    yield elem
+                    section.remove(elem)
+                elif (depth == 2) and (elem.tag == "TRANSACTIONS"):
+                    break
+                depth -= 1
+    return
+
+
+def stream_fix(inputfile, outputfile, opts, profiler=None):
+    # Sections preceding TRANSACTIONS (accounts, payees, tags, etc.) are kept in memory,
+    # every TRANSACTION element is fixed, written out and freed as soon as it is parsed.
+    # Sections following TRANSACTIONS are written out one by one.
+    # An element's tail is known only after the next element starts, so each element
+    # is written out at the start of its next sibling or at the end of its parent.
+    state = None
+    root = None
+    txns_elem = None
+    pending_section = None
+    pending_txn = None
+    pending_elem = None
+    section = None
+    depth = 0
+    n_txns = 0
+    with open_input(inputfile) as f_in, replace_output(outputfile, opts["compress_level"]) as f:
+        parser = ET.XMLParser(encoding="utf-8")
+        context = ET.iterparse(f_in, events=("start", "end"), parser=parser)
+        out = KMyMoneyWriter(f)
+        if profiler is not None:
+            for k in ("header", "start", "text", "end", "element", "transaction", "footer"):
+                setattr(out, k, profiler.wrap("output", getattr(out, k), items=0))
+            profiler.begin("stream")
+        out.header()
+        for event, elem in context:
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2:
+                    section = elem
+                if (depth == 2) and (state is not None):
+                    if pending_section is not None:
+                        if pending_section is txns_elem:
+                            out.text(pending_section.tail)
+                        else:
+                            out.element(pending_section)
+                        root.remove(pending_section)
+                        pending_section = None
+                elif (depth == 2) and (elem.tag == "TRANSACTIONS"):
+                    # All lookup tables are available at this point
+                    with profile_stage(profiler, "prepare"):
+                        state = prepare_fixers(root, opts, profiler, txn_split_accounts(map(Transaction, iter_transactions(inputfile))))
+                    out.start(root)
+                    out.text(root.text)
+                    # The parser may run ahead of the events, so stop at TRANSACTIONS
+                    for prev_section in list(root):
+                        if prev_section is elem:
+                            break
+                        out.element(prev_section)
+                        root.remove(prev_section)
+                    txns_elem = elem
+                elif (depth == 3) and (elem.tag == "TRANSACTION") and (section is txns_elem):
+                    if pending_txn is None:
+                        out.start(txns_elem)
+                        out.text(txns_elem.text)
+                    else:
+                        out.transaction(pending_txn, with_tail=False)
+                        out.text(pending_elem.tail)
+                        txns_elem.remove(pending_elem)
+                        pending_txn = None
+            else:
+                if (depth == 3) and (elem.tag == "TRANSACTION") and (section is txns_elem):
+                    with profile_stage(profiler, "fixers", 1):
+                        pending_txn = Transaction(elem)
+                        apply_transaction_fixers([pending_txn], state, opts)
+                    pending_elem = elem
+                    n_txns += 1
+                elif (depth == 2) and (state is not None):
+                    if elem is txns_elem:
+                        if pending_txn is None:
+                            # Empty TRANSACTIONS section
+                            out.element(txns_elem, with_tail=False)
+                        else:
+                            out.transaction(pending_txn, with_tail=False)
+                            out.text(pending_elem.tail)
+                            txns_elem.remove(pending_elem)
+                            pending_txn = None
+                            out.end(txns_elem)
+                    pending_section = elem
+                elif depth == 1:
+                    if state is None:
+                        # No TRANSACTIONS section, the whole document is in memory
+                        with profile_stage(profiler, "prepare"):
+                            state = prepare_fixers(root, opts, profiler)
+                        out.element(root, with_tail=False)
+                    else:
+                        if pending_section is txns_elem:
+                            out.text(pending_section.tail)
+                        elif pending_section is not None:
+                            out.element(pending_section)
+                        out.end(root)
+                    out.footer(root)
+                depth -= 1
+        if profiler is not None:
+            profiler.end(n_txns)
+    finish_fixers(state, opts)
+    if profiler is not None:
+        profiler.set_items("output", n_txns)
+        profiler.remainder("parse", "stream")
+    return state
+
+
+def load_fix(inputfile, outputfile, opts, profiler=None):
+    # Sections preceding and following TRANSACTIONS are kept as elements, transactions are
+    # loaded into the model, fixed and written out together with them
+    # ============== PARSING XML ================
+    with profile_stage(profiler, "parse"):
+        root, transactions = load_document(inputfile)
+
+    with profile_stage(profiler, "prepare"):
+        state = prepare_fixers(root, opts, profiler, txn_split_accounts(transactions))
+
+    # ============== TRANSACTIONS ===============
+    with profile_stage(profiler, "fixers", len(transactions)):
+        apply_transaction_fixers(transactions, state, opts)
+    finish_fixers(state, opts)
+
+    # ============== OUTPUT =====================
+    with profile_stage(profiler, "output", len(transactions)):
+        write_output(root, outputfile, opts["compress_level"], transactions)
+    if profiler is not None:
+        profiler.set_items("parse", len(transactions))
+    return state
+
+
+def fix_file(inputfile, outputfile, opts):
+    # Profiling report is written next to the output file
+    profiler = Profiler() if "to_profile" in opts else None
+    cache = open_cache(inputfile, opts)
+    if "to_diff" in opts:
+        state = diff_file(inputfile, outputfile, opts, profiler)
+    elif "to_stream" in opts:
+        state = stream_fix(inputfile, outputfile, opts, profiler)
+    else:
+        state = section_fix(inputfile, outputfile, opts, profiler, cache)
+
+    if profiler is not None:
+        profiler.finish(f"{outputfile}.profile.json")
+    return state
+
+
+def default_output_file(inputfile):
+    stem, ext = os.path.splitext(inputfile)
+    return f"{stem}_fixed{ext}"
+
+
+# ============== PARALLEL JOBS ==============
+# Number of transactions processed by a worker at once
+JOB_CHUNK_SIZE = 1000
+
+TXNS_START_RE = re.compile(rb"""<TRANSACTIONS(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*(/?)>""")
+TXN_START_RE = re.compile(rb"<TRANSACTION[\s/>]")
+
+# Lookup tables and options of a worker process, set once when the worker starts
+WORKER_STATE = dict()
+
+
+def split_transactions(data):
+    # Byte offsets of the TRANSACTIONS section of a document: end of its start tag, starts
+    # of all transactions and start of its end tag. Transactions are not nested and "<" is
+    # always escaped in attribute values and text, so the section is split without parsing it.
+    # Returns None if there are no transactions.
+    m = TXNS_START_RE.search(data)
+    if (m is None) or (m.group(1) == b"/"):
+        return None
+    body_start = m.end()
+    body_end = data.find(b"</TRANSACTIONS", body_start)
+    if body_end < 0:
+        return None
+    starts = [k.start() for k in TXN_START_RE.finditer(data, body_start, body_end)]
+    if len(starts) == 0:
+        return None
+    return body_start, starts, body_end
+
+
+def parse_chunk(chunk):
+    # Chunk holds consecutive transactions, each followed by its tail
+    parser = ET.XMLParser(encoding="utf-8")
+    return ET.fromstring(b"<TRANSACTIONS>" + chunk + b"</TRANSACTIONS>", parser=parser)
+
+
+def chunk_split_accounts(chunk):
+    return list(txn_split_accounts(map(Transaction, parse_chunk(chunk))))
+
+
+def init_fix_worker(state, opts):
+    WORKER_STATE["state"] = state
+    WORKER_STATE["opts"] = opts
+    return
+
+
+def parse_transactions(chunk, profiler=None):
+    # Transactions of a chunk loaded into the model
+    if profiler is not None:
+        profiler.begin("parse")
+    transactions = [Transaction(item) for item in parse_chunk(chunk)]
+    if profiler is not None:
+        profiler.end(len(transactions))
+    return transactions
+
+
+def fix_text(chunk, state, opts, profiler=None):
+    # Fixed transactions of a chunk serialized together with their tails, and their number
+    transactions = parse_transactions(chunk, profiler)
+    with profile_stage(profiler, "fixers", len(transactions)):
+        apply_transaction_fixers(transactions, state, opts)
+    with profile_stage(profiler, "output"):
+        text = io.StringIO()
+        out = KMyMoneyWriter(text)
+        for txn in transactions:
+            out.transaction(txn)
+        out.flush()
+    return text.getvalue(), len(transactions)
+
+
+def fix_chunk(chunk, position, numbers):
+    # Fix transactions of a chunk and serialize them. "position" is the position of
+    # the first transaction of the chunk in the file, "numbers" are its split numbers.
+    state = WORKER_STATE["state"]
+    opts = WORKER_STATE["opts"]
+    state["cnt_all"] = 0
+    state["cnt_emp"] = 0
+    state["txn_numbers"] = numbers
+    state["txn_position"] = position
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
+        text, cnt_txns = fix_text(chunk, state, opts)
+    return {"text": text, "report": report.getvalue(), "cnt_all": state["cnt_all"],
+            "cnt_emp": state["cnt_emp"], "cnt_txns": cnt_txns}
+
+
+def write_chunk(out, result, state):
+    # Reports and counters of chunks are merged in the order of transactions
+    print(result["report"], end="")
+    state["cnt_all"] += result["cnt_all"]
+    state["cnt_emp"] += result["cnt_emp"]
+    out.serialized(result["text"])
+    out.flush()
+    return result["cnt_txns"]
+
+
+def fix_in_parallel(out, data, bounds, state, opts):
+    # Chunks of transactions are parsed, fixed and serialized by worker processes. Lookup tables
+    # are sent to every worker once, the fixed chunks are written out in the original order.
+    jobs = opts["jobs"]
+    n_chunks = len(bounds) - 1
+    # Split numbers are sent along with their chunks
+    chunk_numbers = [None] * n_chunks
+    if "set_txn_numbers_flag" in opts:
+        chunk_numbers = [dict() for k in range(n_chunks)]
+        for (i, j), number in state.pop("txn_numbers").items():
+            chunk_numbers[i // JOB_CHUNK_SIZE][(i, j)] = number
+    n_txns = 0
+    # Number of chunks in flight is limited, so that memory usage stays bounded
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_fix_worker, initargs=(state, opts)) as pool:
+        for k, chunk in enumerate(iter_chunks(data, bounds)):
+            pending.append(pool.submit(fix_chunk, chunk, k * JOB_CHUNK_SIZE, chunk_numbers[k]))
+            if len(pending) >= 4 * jobs:
+                n_txns += write_chunk(out, pending.popleft().result(), state)
+        while len(pending) > 0:
+            n_txns += write_chunk(out, pending.popleft().result(), state)
+    return n_txns
+
+
+# Whitespace between transactions, which is written out as it is read
+TXN_TAIL_RE = re.compile(rb"[ \t\n]*")
+TXN_TEXT_START_RE = re.compile(r"<TRANSACTION[\s/>]")
+
+
+def cache_parts(data, starts, body_end, cache):
+    # Transactions split into runs copied from the input ("copy", start, end), transactions written
+    # out from the cache ("text", text) and runs of transactions to be fixed ("fix", misses, end),
+    # in the order of the input. Misses are (start, end, hash) of transactions without their tails.
+    copy_start = None
+    misses = []
+    for start, nxt in zip(starts, starts[1:] + [body_end]):
+        end = data.rfind(b">", start, nxt) + 1
+        txn_hash = None
+        if TXN_TAIL_RE.fullmatch(data, end, nxt):
+            txn_hash = transaction_hash(data[start:end])
+        text = cache.get(txn_hash)
+        if text is None:
+            if copy_start is not None:
+                yield ("copy", copy_start, start)
+                copy_start = None
+            misses.append((start, end, txn_hash))
+            if len(misses) >= JOB_CHUNK_SIZE:
+                yield ("fix", misses, nxt)
+                misses = []
+            continue
+        if len(misses) > 0:
+            yield ("fix", misses, start)
+            misses = []
+        if (text == "") and (end < nxt):
+            # Unchanged transactions followed by whitespace are copied together
+            if copy_start is None:
+                copy_start = start
+            continue
+        if copy_start is not None:
+            yield ("copy", copy_start, start)
+            copy_start = None
+        # Tags are divided with a line break, see "text_before_tag"
+        tail = data[end:nxt].decode("utf-8") or "\n"
+        yield ("text", (text or data[start:end].decode("utf-8")) + tail)
+    if copy_start is not None:
+        yield ("copy", copy_start, body_end)
+    if len(misses) > 0:
+        yield ("fix", misses, body_end)
+    return
+
+
+def record_fixed(cache, data, misses, text):
+    # Serialized transactions are split at their starts, "<" is always escaped elsewhere
+    offsets = [m.start() for m in TXN_TEXT_START_RE.finditer(text)]
+    if len(offsets) != len(misses):
+        return
+    for (start, end, txn_hash), k, nxt in zip(misses, offsets, offsets[1:] + [len(text)]):
+        if txn_hash is None:
+            continue
+        body = text[k:text.rfind(">", k, nxt) + 1]
+        cache.record(txn_hash, "" if body.encode("utf-8") == data[start:end] else body)
+    return
+
+
+def write_part(out, data, part, state, opts, profiler=None):
+    cache = state["cache"]
+    kind = part[0]
+    if kind == "fix":
+        misses, end = part[1], part[2]
+        text, n_txns = fix_text(data[misses[0][0]:end], state, opts, profiler)
+        record_fixed(cache, data, misses, text)
+    elif kind == "fixed":
+        # Chunk fixed by a worker process
+        misses, future = part[1], part[2]
+        with profile_stage(profiler, "fixers", len(misses)):
+            result = future.result()
+        record_fixed(cache, data, misses, result["text"])
+    with profile_stage(profiler, "output"):
+        if kind == "copy":
+            out.raw(data, part[1], part[2])
+        elif kind == "text":
+            out.serialized(part[1])
+        elif kind == "fix":
+            out.serialized(text)
+            out.flush()
+        else:
+            write_chunk(out, result, state)
+        if len(out.parts) >= out.max_parts:
+            out.flush()
+    return
+
+
+def fix_cached(out, data, starts, body_end, state, opts, profiler=None):
+    # Transactions found in the cache are copied from the input as they are or written out from
+    # the cache without being parsed. Others are fixed in chunks, by worker processes if "jobs"
+    # is given, and recorded in the cache.
+    jobs = opts.get("jobs", 1)
+    pool = contextlib.nullcontext()
+    if "jobs" in opts:
+        # Connection to the cache database stays in this process
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_fix_worker,
+                                   initargs=(dict(state, cache=None), opts))
+    # Parts are written out in the original order, number of chunks in flight is limited
+    pending = collections.deque()
+    n_chunks = 0
+    with pool:
+        for part in cache_parts(data, starts, body_end, state["cache"]):
+            if (part[0] == "fix") and ("jobs" in opts):
+                kind, misses, end = part
+                part = ("fixed", misses, pool.submit(fix_chunk, data[misses[0][0]:end], None, None))
+                n_chunks += 1
+            pending.append(part)
+            while (len(pending) > 0) and ((pending[0][0] != "fixed") or (n_chunks >= 4 * jobs)):
+                if pending[0][0] == "fixed":
+                    n_chunks -= 1
+                write_part(out, data, pending.popleft(), state, opts, profiler)
+        while len(pending) > 0:
+            write_part(out, data, pending.popleft(), state, opts, profiler)
+    out.flush()
+    return len(starts)
+
+
+# ============== SECTIONS ===================
+ROOT_START_RE = re.compile(rb"<[^?!]")
+TAG_START_RE = re.compile(rb"""<([^\s/>!?]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*(/?)>""")
+
+
+def find_section_end(data, name, pos):
+    # Offset following the end tag of a section whose start tag ends at "pos"
+    depth = 1
+    tag_re = re.compile(rb"<(/?)" + re.escape(name) + rb"[\s/>]")
+    for m in tag_re.finditer(data, pos):
+        if m.group(1) == b"/":
+            depth -= 1
+            if depth == 0:
+                return data.find(b">", m.end() - 1) + 1
+        else:
+            start_tag = TAG_START_RE.match(data, m.start())
+            if start_tag is None:
+                return None
+            if start_tag.group(2) != b"/":
+                depth += 1
+    return None
+
+
+def locate_sections(data):
+    # Byte offsets of the start of the root element, the end of its start tag, (name, start, end)
+    # of all sections and the start of the end tag of the root element. "<" is always escaped
+    # in attribute values and text, so sections are located without parsing them.
+    # Returns None if the document holds anything else between sections (e.g. comments).
+    m = ROOT_START_RE.search(data)
+    if m is None:
+        return None
+    m = TAG_START_RE.match(data, m.start())
+    if (m is None) or (m.group(2) == b"/"):
+        return None
+    root_start = m.start()
+    root_body = m.end()
+    sections = []
+    pos = root_body
+    while True:
+        lt = data.find(b"<", pos)
+        if lt < 0:
+            return None
+        if data[lt:lt + 2] == b"</":
+            return root_start, root_body, sections, lt
+        m = TAG_START_RE.match(data, lt)
+        if m is None:
+            return None
+        end = m.end()
+        if m.group(2) != b"/":
+            end = find_section_end(data, m.group(1), m.end())
+            if end is None:
+                return None
+        sections.append((m.group(1).decode("utf-8"), lt, end))
+        pos = end
+
+
+def parse_sections(data, located, names):
+    # Root element holding only the sections with given names
+    root_start, root_body, sections, root_end = located
+    parts = [data[root_start:root_body]]
+    parts += [data[start:end] for name, start, end in sections if name in names]
+    parts.append(data[root_end:])
+    parser = ET.XMLParser(encoding="utf-8")
+    return ET.fromstring(b"".join(parts), parser=parser)
+
+
+def iter_chunks(data, bounds):
+    for k in range(len(bounds) - 1):
+        yield data[bounds[k]:bounds[k + 1]]
+    return
+
+
+def iter_transaction_chunks(data, bounds, profiler=None):
+    for chunk in iter_chunks(data, bounds):
+        yield parse_transactions(chunk, profiler)
+    return
+
+
+def fix_chunks(out, txn_chunks, state, opts, profiler=None):
+    n_txns = 0
+    for transactions in txn_chunks:
+        with profile_stage(profiler, "fixers", len(transactions)):
+            apply_transaction_fixers(transactions, state, opts)
+        with profile_stage(profiler, "output"):
+            for txn in transactions:
+                out.transaction(txn)
+            out.flush()
+        n_txns += len(transactions)
+    return n_txns
+
+
+def section_fix(inputfile, outputfile, opts, profiler=None, cache=None):
+    # Sections which no requested operation modifies are copied to the output as byte ranges of
+    # the memory-mapped input. Sections needed for lookup tables are parsed, modified sections are
+    # written out anew. Transactions are parsed, fixed and written out in chunks, by worker
+    # processes if "jobs" is given. Transactions found in the cache are not parsed (see "fix_cached").
+    needs = execution_plan(opts)
+    modified = {k for k in needs if k.isupper()}
+    parsed = (modified | {TABLE_SECTIONS[k] for k in needs if k in TABLE_SECTIONS}) - {"TRANSACTIONS"}
+    with map_input(inputfile) as data:
+        with profile_stage(profiler, "parse"):
+            located = locate_sections(data)
+            ranges = None
+            if (located is not None) and ("TRANSACTIONS" in modified):
+                ranges = split_transactions(data)
+                txns_sections = [(start, end) for name, start, end in located[2] if name == "TRANSACTIONS"]
+                if (ranges is not None) and ((len(txns_sections) != 1) or (ranges[0] < txns_sections[0][0])
+                                             or (ranges[2] > txns_sections[0][1])):
+                    located = None
+            if located is None:
+                # Document is not split into sections
+                if cache is not None:
+                    cache.close()
+                return load_fix(inputfile, outputfile, opts, profiler)
+            root = parse_sections(data, located, parsed)
+
+        txn_accounts = None
+        if ranges is not None:
+            body_start, starts, body_end = ranges
+            bounds = starts[::JOB_CHUNK_SIZE] + [body_end]
+            txn_chunks = iter_transaction_chunks(data, bounds, profiler)
+            if ("set_txn_numbers_flag" in opts) and ("jobs" in opts):
+                with profile_stage(profiler, "transaction numbers", len(starts)):
+                    with ProcessPoolExecutor(max_workers=opts["jobs"]) as pool:
+                        txn_accounts = [k for part in pool.map(chunk_split_accounts, iter_chunks(data, bounds))
+                                        for k in part]
+            elif "set_txn_numbers_flag" in opts:
+                # All transactions are needed in advance, so they are kept in memory
+                txn_chunks = list(txn_chunks)
+                txn_accounts = txn_split_accounts(txn for k in txn_chunks for txn in k)
+        with profile_stage(profiler, "prepare"):
+            # Fixers are not profiled in worker processes
+            state = prepare_fixers(root, opts, None if "jobs" in opts else profiler, txn_accounts, cache)
+
+        # Parsing and fixing of transactions are interleaved with writing, the "output" stage
+        # measures only writing
+        n_txns = 0
+        with replace_output(outputfile, opts["compress_level"]) as f:
+            out = KMyMoneyWriter(f)
+            root_start, root_body, sections, root_end = located
+            elems = iter(root)
+            pos = root_start
+            with profile_stage(profiler, "output"):
+                out.header()
+            for name, start, end in sections:
+                if name in parsed:
+                    elem = next(elems)
+                if (name == "TRANSACTIONS") and (ranges is not None):
+                    with profile_stage(profiler, "output"):
+                        out.raw(data, pos, starts[0])
+                    if state["cache"] is not None:
+                        n_txns = fix_cached(out, data, starts, body_end, state, opts, profiler)
+                    elif "jobs" in opts:
+                        with profile_stage(profiler, "fixers", len(starts)):
+                            n_txns = fix_in_parallel(out, data, bounds, state, opts)
+                    else:
+                        n_txns = fix_chunks(out, txn_chunks, state, opts, profiler)
+                    pos = body_end
+                    continue
+                with profile_stage(profiler, "output"):
+                    if (name in modified) and (name in parsed):
+                        out.raw(data, pos, start)
+                        out.element(elem, with_tail=False)
+                        out.flush()
+                    else:
+                        out.raw(data, pos, end)
+                pos = end
+            with profile_stage(profiler, "output"):
+                out.raw(data, pos, len(data))
+    finish_fixers(state, opts)
+    if profiler is not None:
+        profiler.set_items("output", n_txns)
+    return state
+
+
+# ============== REPORT =====================
+ReportColumns = ["txn_id", "postdate", "account", "account_type", "payee", "tags", "amount", "currency"]
+
+
+class CsvReportWriter:
+    def __init__(self, outputfile, columns=ReportColumns):
+        self.f = open_output(outputfile)
+        self.writer = csv.writer(self.f, lineterminator="\n")
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        return
+
+    def close(self):
+        self.f.close()
+        return
+
+
+# Decimal places of amounts in Parquet/Arrow reports, amounts with more of them
+# (or whose decimal representation does not terminate) are rounded
+ARROW_AMOUNT_SCALE = 12
+
+
+def report_decimal(text, scale=ARROW_AMOUNT_SCALE):
+    # Amount written by "exact_decimal" as a decimal with "scale" decimal places
+    num, sep, den = text.partition("/")
+    with localcontext() as ctx:
+        # Up to 38 digits fit into a 128-bit decimal
+        ctx.prec = 38
+        amount = Decimal(num) / Decimal(den) if sep != "" else Decimal(num)
+        return amount.quantize(Decimal(1).scaleb(-scale))
+
+
+class ArrowReportWriter:
+    # Rows are written in record batches, so that memory usage does not grow with the number of rows.
+    # Post dates are dates, amounts are 128-bit decimals, other columns are strings.
+    def __init__(self, outputfile, batch_size=65536):
+        types = {"postdate": pyarrow.date32(), "amount": pyarrow.decimal128(38, ARROW_AMOUNT_SCALE)}
+        self.schema = pyarrow.schema([(name, types.get(name, pyarrow.string())) for name in ReportColumns])
+        if outputfile.endswith(".parquet"):
+            self.writer = pyarrow.parquet.ParquetWriter(outputfile, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(outputfile, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def flush(self):
+        if len(self.rows) > 0:
+            columns = []
+            for name, column in zip(ReportColumns, zip(*self.rows)):
+                if name == "postdate":
+                    # Dates are written as "YYYY-MM-DD", missing ones become nulls
+                    columns.append(pyarrow.array([k or None for k in column], pyarrow.string()).cast(pyarrow.date32()))
+                elif name == "amount":
+                    columns.append(pyarrow.array([report_decimal(k) for k in column], self.schema.field(name).type))
+                else:
+                    columns.append(pyarrow.array(column, pyarrow.string()))
+            self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+            self.rows = []
+        return
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        return
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        return
+
+
+def open_report_writer(outputfile):
+    # Report format is chosen by the extension of the output file, CSV by default
+    if outputfile.endswith((".parquet", ".arrow", ".feather")):
+        if pyarrow is None:
+            print("Parquet and Arrow reports require the pyarrow package.")
+            return None
+        return ArrowReportWriter(outputfile)
+    return CsvReportWriter(outputfile)
+
+
+def prepare_report(root, opts):
+    # Lookup tables of sections preceding TRANSACTIONS, fixer options are ignored in report mode
+    state = prepare_fixers(root, {"to_report": True})
+    state["report_acnt_ids"] = None
+    if "report_account" in opts:
+        state["report_acnt_ids"] = {acnt_id for acnt_id, acnt_name in state["account_index"].full_name.items()
+                                    if opts["report_account"] in acnt_name}
+    state["report_tag_id"] = None
+    if "report_tag" in opts:
+        state["report_tag_id"] = find_tag_id(state["tag_ids"], opts["report_tag"])
+    return state
+
+
+def report_rows(item, state, opts):
+    # One row per split of a transaction passing the filters
+    postdate = item.get("postdate", "")
+    if ("report_from" in opts) and (postdate < opts["report_from"]):
+        return []
+    if ("report_to" in opts) and (postdate > opts["report_to"]):
+        return []
+    acnt_index = state["account_index"]
+    acnt_ids = state["report_acnt_ids"]
+    tag_id = state["report_tag_id"]
+    rows = []
+    for spl in item.iterfind("./SPLITS/SPLIT"):
+        acnt_id = spl.get("account")
+        if (acnt_ids is not None) and (acnt_id not in acnt_ids):
+            continue
+        tag_ids = [k.get("id") for k in spl.iterfind("./TAG")]
+        if ("report_tag" in opts) and (tag_id not in tag_ids):
+            continue
+        payee_id = spl.get("payee", "")
+        amount = parse_amount(spl.get("price", "1/1")) * parse_amount(spl.get("value", "0/1"))
+        rows.append((
+            item.get("id", ""),
+            postdate,
+            acnt_index.full_name[acnt_id],
+            acnt_index.type_name[acnt_id],
+            state["payees"][payee_id].name if payee_id != "" else "",
+            ",".join(state["tags"][k].name if k in state["tags"] else k for k in tag_ids),
+            exact_decimal(amount),
+            state["accounts"][acnt_id].currency,
+        ))
+    return rows
+
+
+def report_file(inputfile, outputfile, opts):
+    # Read-only mode: transactions are streamed into a table with one row per split
+    writer = open_report_writer(outputfile)
+    if writer is None:
+        return False
+    state = dict()
+    cnt_txns = 0
+    cnt_rows = 0
+    for item in iter_transactions(inputfile, lambda root: state.update(prepare_report(root, opts))):
+        rows = report_rows(item, state, opts)
+        writer.write(rows)
+        cnt_txns += 1
+        cnt_rows += len(rows)
+    writer.close()
+    print(f"Report: {cnt_rows} splits of {cnt_txns} transactions were written to {outputfile}.")
+    return True
+
+
+def default_report_file(inputfile):
+    stem, ext = os.path.splitext(inputfile)
+    return f"{stem}_report.csv"
+
+
+# ============== VALIDATION =================
+BalanceColumns = ["account", "postdate", "txn_id", "shares", "balance"]
+
+# Integers summed or multiplied in 64-bit arrays stay below this limit, others are handled by Python integers
+INT64_LIMIT = 2**62
+
+# Number of decimal places of denominators which are powers of 10
+DECIMAL_SCALES = {10**k: k for k in range(19)}
+
+
+@functools.lru_cache(maxsize=65536)
+def amount_parts(value):
+    # Numerator and denominator of a "numerator/denominator" string as they are written, not reduced.
+    # Returns None if the string is not an amount.
+    num, sep, den = value.partition("/")
+    try:
+        num = int(num)
+        den = int(den) if sep != "" else 1
+    except ValueError:
+        return None
+    if den <= 0:
+        return None
+    return num, den
+
+
+def decimal_text(num, den):
+    # Same as "exact_decimal(Fraction(num, den))", without fractions for denominators which are powers of 10
+    scale = DECIMAL_SCALES.get(den)
+    if scale is None:
+        return exact_decimal(Fraction(num, den))
+    q, r = divmod(abs(num), den)
+    sign = "-" if num < 0 else ""
+    if r == 0:
+        return f"{sign}{q}"
+    return f"{sign}{q}.{r:0{scale}d}".rstrip("0")
+
+
+def int64_array(values):
+    # 64-bit integer array of values and the mask of values within INT64_LIMIT,
+    # values out of the limit are replaced with 0
+    try:
+        array = numpy.array(values, dtype=numpy.int64)
+        valid = (array > -INT64_LIMIT) & (array < INT64_LIMIT)
+    except OverflowError:
+        valid = numpy.array([-INT64_LIMIT < k < INT64_LIMIT for k in values], dtype=bool)
+        array = numpy.array([k if -INT64_LIMIT < k < INT64_LIMIT else 0 for k in values], dtype=numpy.int64)
+    array[~valid] = 0
+    return array, valid
+
+
+def group_starts(groups):
+    # Offsets of runs of equal values in an array
+    return numpy.flatnonzero(numpy.concatenate(([True], groups[1:] != groups[:-1])))
+
+
+def summable_groups(nums, valid, dens, starts):
+    # Groups whose amounts share the denominator and whose sums of absolute numerators
+    # stay within INT64_LIMIT, so that any partial sum of them is exact in 64-bit integers
+    ok = numpy.logical_and.reduceat(valid, starts)
+    ok &= numpy.maximum.reduceat(dens, starts) == numpy.minimum.reduceat(dens, starts)
+    ok &= numpy.add.reduceat(numpy.abs(nums).astype(numpy.float64), starts) < INT64_LIMIT
+    return ok
+
+
+def add_amount(total, num, den):
+    # Exact sum of a pair of numerator and denominator and an amount, Python integers are summed
+    # as they are if the denominators are equal, so the sum is not reduced
+    if total[1] == den:
+        return total[0] + num, den
+    amount = Fraction(*total) + Fraction(num, den)
+    return amount.numerator, amount.denominator
+
+
+def transaction_sums(split_txns, nums, dens):
+    # Exact nonzero sums of split values per transaction as pairs of numerator and denominator.
+    # Splits of a transaction are consecutive. Transactions whose splits share the denominator and
+    # whose sums fit into 64-bit integers are summed in arrays, all others by "add_amount".
+    sums = dict()
+    exact = range(len(nums))
+    if (numpy is not None) and (len(nums) > 0):
+        txns = numpy.array(split_txns, dtype=numpy.int64)
+        nums_arr, nums_valid = int64_array(nums)
+        dens_arr, dens_valid = int64_array(dens)
+        starts = group_starts(txns)
+        ok = summable_groups(nums_arr, nums_valid & dens_valid, dens_arr, starts)
+        group_sums = numpy.add.reduceat(nums_arr, starts)
+        for k in numpy.flatnonzero(ok & (group_sums != 0)).tolist():
+            sums[split_txns[starts[k]]] = (int(group_sums[k]), dens[starts[k]])
+        sizes = numpy.diff(numpy.append(starts, len(nums)))
+        exact = numpy.flatnonzero(~numpy.repeat(ok, sizes)).tolist()
+    exact_txns = set()
+    for k in exact:
+        i = split_txns[k]
+        sums[i] = add_amount(sums[i], nums[k], dens[k]) if i in exact_txns else (nums[k], dens[k])
+        exact_txns.add(i)
+    for i in exact_txns:
+        if sums[i][0] == 0:
+            del sums[i]
+    return sums
+
+
+def price_mismatches(shares, prices, values):
+    # Positions of splits whose value differs from shares times price by more than rounding
+    # to the denominator of the value: |2 (s_n p_n v_d - v_n s_d p_d)| > s_d p_d, where
+    # "shares", "prices" and "values" are pairs of lists of numerators and denominators
+    (s_n, s_d), (p_n, p_d), (v_n, v_d) = shares, prices, values
+    exact = range(len(s_n))
+    mismatches = []
+    if (numpy is not None) and (len(s_n) > 0):
+        arrays = [int64_array(k) for k in (s_n, s_d, p_n, p_d, v_n, v_d)]
+        sn, sd, pn, pd, vn, vd = [k[0] for k in arrays]
+        ok = numpy.logical_and.reduce([k[1] for k in arrays])
+        # Magnitudes of the products are estimated in floating point
+        fsn, fsd, fpn, fpd, fvn, fvd = [numpy.abs(k).astype(numpy.float64) for k in (sn, sd, pn, pd, vn, vd)]
+        ok &= numpy.maximum(fsn * fpn * fvd, fvn * fsd * fpd) < INT64_LIMIT / 4
+        ok &= fsd * fpd < INT64_LIMIT
+        diff = numpy.abs(2 * (sn * pn * vd - vn * sd * pd))
+        mismatches = numpy.flatnonzero(ok & (diff > sd * pd)).tolist()
+        exact = numpy.flatnonzero(~ok).tolist()
+    for k in exact:
+        if abs(2 * (s_n[k] * p_n[k] * v_d[k] - v_n[k] * s_d[k] * p_d[k])) > s_d[k] * p_d[k]:
+            mismatches.append(k)
+    return sorted(mismatches)
+
+
+def running_balances(split_acnts, split_dates, nums, dens):
+    # Order of splits by account, post date and position in the file, and the balance of the account
+    # after every split in this order as pairs of numerator and denominator. Accounts whose splits
+    # share the denominator and whose balances fit into 64-bit integers are summed in arrays,
+    # all others by "add_amount".
+    if (numpy is None) or (len(nums) == 0):
+        order = sorted(range(len(nums)), key=lambda k: (split_acnts[k], split_dates[k]))
+        balances = []
+        acnt = None
+        for k in order:
+            if split_acnts[k] != acnt:
+                acnt = split_acnts[k]
+                balance = (nums[k], dens[k])
+            else:
+                balance = add_amount(balance, nums[k], dens[k])
+            balances.append(balance)
+        return order, balances
+
+    acnts = numpy.array(split_acnts, dtype=numpy.int64)
+    dates = numpy.unique(numpy.array(split_dates), return_inverse=True)[1].reshape(-1)
+    # Sorting is stable, so splits with the same post date keep their order in the file
+    order = numpy.lexsort((dates, acnts))
+    nums_arr, nums_valid = int64_array(nums)
+    dens_arr, dens_valid = int64_array(dens)
+    acnts = acnts[order]
+    nums_arr = nums_arr[order]
+    dens_arr = dens_arr[order]
+    starts = group_starts(acnts)
+    sizes = numpy.diff(numpy.append(starts, len(nums)))
+    ok = numpy.repeat(summable_groups(nums_arr, (nums_valid & dens_valid)[order], dens_arr, starts), sizes)
+    # Cumulative sums may wrap around across accounts, differences within an account are still exact
+    cumsum = numpy.cumsum(nums_arr)
+    cumsum -= numpy.repeat(cumsum[starts] - nums_arr[starts], sizes)
+    order = order.tolist()
+    balances = list(zip(cumsum.tolist(), dens_arr.tolist()))
+    acnt = None
+    for n in numpy.flatnonzero(~ok).tolist():
+        k = order[n]
+        if split_acnts[k] != acnt:
+            acnt = split_acnts[k]
+            balance = (nums[k], dens[k])
+        else:
+            balance = add_amount(balance, nums[k], dens[k])
+        balances[n] = balance
+    return order, balances
+
+
+def validate_file(inputfile, outputfile, opts):
+    # Read-only mode: check that splits of every transaction balance, that values of splits agree with
+    # their shares and prices, that all referenced accounts, payees and tags exist, and write running
+    # balances of all accounts. Amounts of all splits are collected into lists of numerators and
+    # denominators first, which are checked at once. Returns False if any check failed.
+    state = dict()
+    txn_ids = []
+    postdates = []
+    split_txns = []
+    split_pos = []
+    split_acnts = []
+    split_dates = []
+    values = ([], [])
+    shares = ([], [])
+    prices = ([], [])
+    acnt_codes = dict()
+    stock_splits = set()
+    cnt_dangling = 0
+    cnt_invalid = 0
+    for item in iter_transactions(inputfile, lambda root: state.update(prepare_fixers(root, {"to_validate": True}))):
+        accounts = state["accounts"]
+        i = len(txn_ids)
+        txn_id = item.get("id", "")
+        postdate = item.get("postdate", "")
+        txn_ids.append(txn_id)
+        postdates.append(postdate)
+        for j, spl in enumerate(item.iterfind("./SPLITS/SPLIT")):
+            acnt_id = spl.get("account", "")
+            if acnt_id not in accounts:
+                print(f"Transaction {txn_id} split {j}: account {acnt_id} does not exist.")
+                cnt_dangling += 1
+            payee_id = spl.get("payee", "")
+            if (payee_id != "") and (payee_id not in state["payees"]):
+                print(f"Transaction {txn_id} split {j}: payee {payee_id} does not exist.")
+                cnt_dangling += 1
+            if len(spl) > 0:
+                for tag in spl.iterfind("./TAG"):
+                    if tag.get("id") not in state["tags"]:
+                        print(f"Transaction {txn_id} split {j}: tag {tag.get('id')} does not exist.")
+                        cnt_dangling += 1
+            value = amount_parts(spl.get("value", ""))
+            spl_shares = amount_parts(spl.get("shares", ""))
+            # Price may be omitted if shares and value are in the same currency
+            price = amount_parts(spl.get("price") or "1/1")
+            if (value is None) or (spl_shares is None) or (price is None):
+                print(f"Transaction {txn_id} split {j}: value, shares or price is not an amount.")
+                cnt_invalid += 1
+                continue
+            if spl.get("action") == "Split":
+                # Stock splits change the number of shares without a value
+                stock_splits.add(len(split_txns))
+            split_txns.append(i)
+            split_pos.append(j)
+            split_acnts.append(acnt_codes.setdefault(acnt_id, len(acnt_codes)))
+            split_dates.append(postdate)
+            values[0].append(value[0])
+            values[1].append(value[1])
+            shares[0].append(spl_shares[0])
+            shares[1].append(spl_shares[1])
+            prices[0].append(price[0])
+            prices[1].append(price[1])
+    if len(state) == 0:
+        # File has no transactions
+        state.update(prepare_fixers(load_document(inputfile)[0], {"to_validate": True}))
+
+    # Full names of accounts are not known if parents of some accounts do not exist, IDs are printed instead
+    acnt_names = {acnt_id: acnt_id for acnt_id in acnt_codes}
+    cnt_orphans = 0
+    for acnt in state["accounts"].values():
+        if (acnt.parent != "") and (acnt.parent not in state["accounts"]):
+            print(f"Account {acnt.id}: parent account {acnt.parent} does not exist.")
+            cnt_orphans += 1
+    if cnt_orphans == 0:
+        acnt_names.update(AccountIndex(state["accounts"]).full_name)
+    cnt_dangling += cnt_orphans
+
+    # ============== BALANCE ====================
+    unbalanced = transaction_sums(split_txns, *values)
+    for i, (num, den) in sorted(unbalanced.items()):
+        print(f"Transaction {txn_ids[i]} ({postdates[i]}): splits do not balance, "
+              f"sum of values is {decimal_text(num, den)}.")
+    mismatches = [k for k in price_mismatches(shares, prices, values) if k not in stock_splits]
+    for k in mismatches:
+        amount = Fraction(shares[0][k], shares[1][k]) * Fraction(prices[0][k], prices[1][k])
+        print(f"Transaction {txn_ids[split_txns[k]]} split {split_pos[k]}: value "
+              f"{decimal_text(values[0][k], values[1][k])} differs from shares times price {exact_decimal(amount)}.")
+
+    # ============== RUNNING BALANCES ===========
+    acnt_ids = list(acnt_codes)
+    order, balances = running_balances(split_acnts, split_dates, *shares)
+    writer = CsvReportWriter(outputfile, BalanceColumns)
+    writer.write((acnt_names[acnt_ids[split_acnts[k]]], split_dates[k], txn_ids[split_txns[k]],
+                  decimal_text(shares[0][k], shares[1][k]), decimal_text(*balance))
+                 for k, balance in zip(order, balances))
+    writer.close()
+    closing = {acnt_ids[split_acnts[k]]: balance for k, balance in zip(order, balances)}
+
+    print("============== BALANCES ===================")
+    for acnt_id, balance in sorted(closing.items(), key=lambda k: acnt_names[k[0]]):
+        if acnt_id in state["accounts"]:
+            print(f"{acnt_names[acnt_id]}: {decimal_text(*balance)} {state['accounts'][acnt_id].currency}")
+        else:
+            print(f"{acnt_names[acnt_id]}: {decimal_text(*balance)}")
+    print(f"Count of transactions whose splits do not balance: {len(unbalanced)}")
+    print(f"Count of splits whose value differs from shares times price: {len(mismatches)}")
+    print(f"Count of references to accounts, payees and tags which do not exist: {cnt_dangling}")
+    print(f"Count of splits with invalid amounts: {cnt_invalid}")
+    print(f"Running balances of {len(closing)} accounts were written to {outputfile}.")
+    return (len(unbalanced) == 0) and (len(mismatches) == 0) and (cnt_dangling == 0) and (cnt_invalid == 0)
+
+
+def default_balances_file(inputfile):
+    stem, ext = os.path.splitext(inputfile)
+    return f"{stem}_balances.csv"
+
+
+# ============== DRY RUN ====================
+def transaction_snapshot(item):
+    # Attributes of a transaction, attributes and tags of its splits
+    return dict(item.items()), [(dict(spl.items()), spl.tag_ids()) for spl in item.splits]
+
+
+def attribute_changes(old_attrs, new_attrs):
+    changes = []
+    for name in list(old_attrs) + [k for k in new_attrs if k not in old_attrs]:
+        if old_attrs.get(name) != new_attrs.get(name):
+            changes.append({"attribute": name, "old": old_attrs.get(name), "new": new_attrs.get(name)})
+    return changes
+
+
+def snapshot_changes(fixer_name, before, after):
+    # Changes of a transaction made by a fixer, split-level changes refer to splits by their position
+    changes = []
+    for change in attribute_changes(before[0], after[0]):
+        changes.append({"fixer": fixer_name, **change})
+    for j, ((old_attrs, old_tags), (new_attrs, new_tags)) in enumerate(zip(before[1], after[1])):
+        for change in attribute_changes(old_attrs, new_attrs):
+            changes.append({"fixer": fixer_name, "split": j, **change})
+        if old_tags != new_tags:
+            changes.append({"fixer": fixer_name, "split": j, "element": "TAG", "old": old_tags, "new": new_tags})
+    return changes
+
+
+class ChangeLog:
+    # One JSON object per changed transaction, account or payee. The file is created only
+    # when the first change is written, so nothing is written if nothing changed.
+    def __init__(self, logfile, compress_level=None):
+        self.logfile = logfile
+        self.compress_level = compress_level
+        self.f = None
+        self.cnt_txns = 0
+        self.cnt_changes = 0
+        self.cnt_txn_changes = 0
+
+    def write(self, records):
+        # Records are moved from the list to the file
+        if len(records) == 0:
+            return
+        if self.f is None:
+            self.f = open_output(self.logfile, self.compress_level)
+        for record in records:
+            self.f.write(json.dumps(record, ensure_ascii=False))
+            self.f.write("\n")
+            # Every record holds one or more changes
+            self.cnt_changes += len(record["changes"])
+            if "txn" in record:
+                self.cnt_txns += 1
+                self.cnt_txn_changes += len(record["changes"])
+        records.clear()
+        return
+
+    def close(self):
+        if self.f is None:
+            print(f"Dry run: nothing would be changed, {self.logfile} was not written.")
+            return
+        self.f.close()
+        print(f"Dry run: {self.cnt_changes} changes, {self.cnt_txn_changes} of them in {self.cnt_txns} transactions, "
+              f"were written to {self.logfile}.")
+        return
+
+
+def diff_file(inputfile, logfile, opts, profiler=None):
+    # Fixers are applied to every transaction as it is parsed, the changes they make are written
+    # to a change log instead of writing out the fixed document
+    log = ChangeLog(logfile, opts["compress_level"])
+    state = dict()
+
+    def prepare(root):
+        txn_accounts = txn_split_accounts(map(Transaction, iter_transactions(inputfile)))
+        with profile_stage(profiler, "prepare"):
+            state.update(prepare_fixers(root, opts, profiler, txn_accounts))
+        log.write(state["changes"])
+        return
+
+    n_txns = 0
+    with profile_stage(profiler, "dry run"):
+        for item in iter_transactions(inputfile, prepare):
+            apply_transaction_fixers([Transaction(item)], state, opts)
+            log.write(state["changes"])
+            n_txns += 1
+        if len(state) == 0:
+            # No TRANSACTIONS section
+            root = load_document(inputfile)[0]
+            state.update(prepare_fixers(root, opts, profiler))
+            log.write(state["changes"])
+    if profiler is not None:
+        profiler.set_items("dry run", n_txns)
+    finish_fixers(state, opts)
+    log.close()
+    return state
+
+
+def default_changes_file(inputfile):
+    stem, ext = os.path.splitext(inputfile)
+    return f"{stem}_changes.jsonl"
+
+
+# ============== BATCH MODE =================
+def is_batch_input(path):
+    # KMyMoney/XML file which is not the output of a previous run
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return (ext in (".kmy", ".xml")) and (not stem.endswith("_fixed")) and os.path.isfile(path)
+
+
+def collect_input_files(args):
+    # Arguments may be files, directories or glob patterns not expanded by the shell.
+    # Directories and patterns yield all KMyMoney/XML files except the output of previous runs.
+    inputfiles = []
+    for arg in args:
+        if os.path.isdir(arg):
+            inputfiles += [path for path in (os.path.join(arg, name) for name in sorted(os.listdir(arg)))
+                           if is_batch_input(path)]
+        elif glob.has_magic(arg):
+            inputfiles += [path for path in sorted(glob.glob(arg)) if is_batch_input(path)]
+        else:
+            inputfiles.append(arg)
+    return inputfiles
+
+
+def fix_file_in_worker(inputfile, outputfile, opts):
+    # Messages printed by the fixers are captured, so that reports of files
+    # processed in parallel do not get mixed up
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
+        state = fix_file(inputfile, outputfile, opts)
+    return {"report": report.getvalue(), "cnt_all": state["cnt_all"], "cnt_emp": state["cnt_emp"]}
+
+
+def fix_files(files, opts, workers=None):
+    # Process (input file, output file) pairs in parallel, print the reports in the order
+    # of input files followed by a summary. Return the list of files which failed.
+    failed = []
+    cnt_all = 0
+    cnt_emp = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fix_file_in_worker, inputfile, outputfile, opts) for inputfile, outputfile in files]
+        for (inputfile, outputfile), future in zip(files, futures):
+            print(f"============== {inputfile} ==============")
+            try:
+                result = future.result()
+            except Exception as err:
+                print(f"Failed to process {inputfile}: {err!r}")
+                failed.append(inputfile)
+                continue
+            print(result["report"], end="")
+            print(f"Output file: {outputfile}")
+            cnt_all += result["cnt_all"]
+            cnt_emp += result["cnt_emp"]
+
+    print("============== SUMMARY ==================")
+    print(f"Processed files: {len(files) - len(failed)} of {len(files)}")
+    if "split_type" in opts:
+        print_split_counts(opts["split_type"], cnt_all, cnt_emp)
+    for inputfile in failed:
+        print(f"Failed: {inputfile}")
+    return failed
+
+
 def main(argv):
     try:
         opts, args = getopt.getopt(
             argv[1:],
-            "a:d:hec:i:r:o:m:ns:x:tp:u:",
+            "a:d:hec:i:r:o:m:ns:x:tp:u:R:Sz:w:j:P",
             [
                 "add-tag-if-not-tagged=",
                 "help",
@@ -339,19 +2758,37 @@ def main(argv):
                 "set-expenses-currency=",
                 "excluded-tags=",
                 "in-account=",
-                "replace-tag-with",
-                "move-split-lvl-tag-to-txn-lvl",
+                "replace-tag-with=",
+                "move-split-lvl-tag-to-txn-lvl=",
                 "reorder-tags",
                 "payee-pattern=",
-                "payee-replacement="
+                "payee-replacement=",
+                "payee-rules=",
+                "report",
+                "account=",
+                "from=",
+                "to=",
+                "tag=",
+                "stream",
+                "compression-level=",
+                "workers=",
+                "jobs=",
+                "profile",
+                "cache",
+                "no-cache",
+                "rebuild-cache",
+                "dry-run",
+                "diff",
+                "validate",
             ],
         )
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
 
-    reconcile_flag = None
-    to_erase_number = False
+    fix_opts = {"excluded_tags": [], "compress_level": None}
+    outputfile = None
+    workers = None
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print_help()
@@ -359,162 +2796,153 @@ def main(argv):
         elif opt in ("-o", "--output"):
             outputfile = arg
         elif opt in ("-e", "--erase-txn-numbers"):
-            to_erase_number = True
+            fix_opts["to_erase_number"] = True
         elif opt in ("-a", "--add-tag-if-not-tagged"):
-            to_add_default_tag = True
-            default_tag = arg
+            fix_opts["to_add_default_tag"] = True
+            fix_opts["default_tag"] = arg
         elif opt in ("-x", "--excluded-tags"):
-            to_add_default_tag = True
-            excluded_tags = arg.split(",")
-        elif opt in ("-s", "--fix-splits"):
-            split_type = arg
+            fix_opts["excluded_tags"] = arg.split(",")
+        elif opt in ("-s", "--fix-splits-with-count"):
+            fix_opts["split_type"] = arg
         elif opt in ("-r", "--reconcile-flag"):
-            reconcile_flag = arg
+            fix_opts["reconcile_flag"] = arg
         elif opt in ("-n", "--assign-txn-numbers"):
-            set_txn_numbers_flag = True
+            fix_opts["set_txn_numbers_flag"] = True
         elif opt in ("-c", "--set-expenses-currency"):
-            set_expenses_currency_flag = True
-            expenses_currency = arg
+            fix_opts["set_expenses_currency_flag"] = True
+            fix_opts["expenses_currency"] = arg
         elif opt in ("-i", "--in-account"):
-            set_replace_tag_in_account_flag = True
-            replace_target_account = arg
+            fix_opts["set_replace_tag_in_account_flag"] = True
+            fix_opts["replace_target_account"] = arg
         elif opt in ("-d", "--replace-tag-with"):
-            set_replace_tag_in_account_flag = True
-            old_tag, new_tag = arg.split(",")
+            fix_opts["set_replace_tag_in_account_flag"] = True
+            fix_opts["old_tag"], fix_opts["new_tag"] = arg.split(",")
         elif opt in ("-m", "--move-split-lvl-tag-to-txn-lvl"):
-            set_move_split_lvl_tag_to_txn_lvl = True
-            tag_to_move = arg
+            fix_opts["set_move_split_lvl_tag_to_txn_lvl"] = True
+            fix_opts["tag_to_move"] = arg
         elif opt in ("-t", "--reorder-tags"):
-            to_reorder_tags = True
+            fix_opts["to_reorder_tags"] = True
         elif opt in ("-p", "--payee-pattern"):
-            to_replace_payee = True
-            payee_pattern = arg
+            fix_opts["to_replace_payee"] = True
+            fix_opts["payee_pattern"] = arg
         elif opt in ("-u", "--payee-replacement"):
-            payee_for_replacement = arg
+            fix_opts["payee_for_replacement"] = arg
+        elif opt in ("-R", "--payee-rules"):
+            fix_opts["to_replace_payee"] = True
+            fix_opts["payee_rules_file"] = arg
+        elif opt == "--report":
+            fix_opts["to_report"] = True
+        elif opt == "--validate":
+            fix_opts["to_validate"] = True
+        elif opt == "--account":
+            fix_opts["report_account"] = arg
+        elif opt == "--from":
+            fix_opts["report_from"] = arg
+        elif opt == "--to":
+            fix_opts["report_to"] = arg
+        elif opt == "--tag":
+            fix_opts["report_tag"] = arg
+        elif opt in ("-S", "--stream"):
+            fix_opts["to_stream"] = True
+        elif opt in ("-z", "--compression-level"):
+            if arg not in [str(k) for k in range(10)]:
+                print_help()
+                sys.exit(2)
+            fix_opts["compress_level"] = int(arg)
+        elif opt in ("-P", "--profile"):
+            fix_opts["to_profile"] = True
+        elif opt == "--cache":
+            fix_opts["to_cache"] = True
+        elif opt == "--no-cache":
+            fix_opts["no_cache"] = True
+        elif opt == "--rebuild-cache":
+            fix_opts["to_cache"] = True
+            fix_opts["rebuild_cache"] = True
+        elif opt in ("--dry-run", "--diff"):
+            fix_opts["to_diff"] = True
+        elif opt in ("-w", "--workers"):
+            if not arg.isdigit() or int(arg) < 1:
+                print_help()
+                sys.exit(2)
+            workers = int(arg)
+        elif opt in ("-j", "--jobs"):
+            if not arg.isdigit() or int(arg) < 1:
+                print_help()
+                sys.exit(2)
+            fix_opts["jobs"] = int(arg)
+
+    if len(args) == 0:
+        print_help()
+        sys.exit(2)
 
-    if len(args) == 1:
+    if "to_replace_payee" in fix_opts:
+        # Rule given by "-p" and "-u" is checked before the rules from the file
+        fix_opts["payee_rules"] = []
+        if "payee_pattern" in fix_opts:
+            if "payee_for_replacement" not in fix_opts:
+                print("Payee pattern is given without a payee for replacement.")
+                sys.exit(2)
+            fix_opts["payee_rules"].append((fix_opts["payee_pattern"], fix_opts["payee_for_replacement"]))
+        if "payee_rules_file" in fix_opts:
+            rules = read_payee_rules(fix_opts["payee_rules_file"])
+            if rules is None:
+                sys.exit(2)
+            fix_opts["payee_rules"].extend(rules)
+
+    if "to_validate" in fix_opts:
+        if (len(args) > 1) or os.path.isdir(args[0]) or glob.has_magic(args[0]):
+            print("Validation mode takes a single input file.")
+            sys.exit(2)
         inputfile = args[0]
+        if outputfile is None:
+            outputfile = default_balances_file(inputfile)
+        if not validate_file(inputfile, outputfile, fix_opts):
+            sys.exit(1)
+        return
+
+    if "to_report" in fix_opts:
+        if (len(args) > 1) or os.path.isdir(args[0]) or glob.has_magic(args[0]):
+            print("Report mode takes a single input file.")
+            sys.exit(2)
+        inputfile = args[0]
+        if outputfile is None:
+            outputfile = default_report_file(inputfile)
+        if not report_file(inputfile, outputfile, fix_opts):
+            sys.exit(1)
+        return
 
-    if not ("outputfile" in vars()):
-        tokens = inputfile.split(".")
-        outputfile = f"{''.join(tokens[:-1])}_fixed.{tokens[-1]}"
-
-    # ============== PARSING XML ================
-    parser = ET.XMLParser(encoding="utf-8")
-    tree = ET.parse(inputfile, parser=parser)
-    root = tree.getroot()
-
-    # ============== ACCOUNTS ===================
-    accounts = dict()
-    for k in root.findall("./ACCOUNTS/ACCOUNT"):
-        accounts[k.attrib["id"]] = k.attrib
-
-    # ============== PAYEES =====================
-    payees = dict()
-    for k in root.findall("./PAYEES/PAYEE"):
-        payees[k.attrib["id"]] = k.attrib
-
-    # ================ TAGS =====================
-    tags = dict()
-    for k in root.findall("./TAGS/TAG"):
-        tags[k.attrib["name"]] = k.attrib["id"]
-
-    # ============== TRANSACTIONS ===============
-    transactions = root.findall("./TRANSACTIONS/TRANSACTION")
-
-    if "split_type" in vars():
-        find_mismatches_in_slits(transactions, accounts, payees, split_type)
-
-    if to_erase_number:
-        erase_number(transactions, to_erase_number)
-
-    if reconcile_flag is not None:
-        fix_reconcile_flag(transactions, reconcile_flag)
-
-    if "set_txn_numbers_flag" in vars():
-        for account in root.findall("./ACCOUNTS/ACCOUNT[@parentaccount='AStd::Asset']"):
-            assign_txn_numbers(root, account.get("id"))
-
-    if "set_expenses_currency_flag" in vars():
-        p = re.compile('^Expenses:')
-        for account in root.findall("./ACCOUNTS/ACCOUNT"):
-            acnt_name = traverse_account_hierarchy_backwards(accounts, account.get("id"))
-            if p.match(acnt_name):
-                account.set("currency", expenses_currency)
-
-    if "to_add_default_tag" in vars():
-        add_default_tag(transactions, accounts, tags, default_tag, excluded_tags)
-
-    if "set_replace_tag_in_account_flag" in vars():
-        # ============== REVERSE ACCOUNTS ===========
-        rev_accounts = dict()
-        for account in root.findall("./ACCOUNTS/ACCOUNT"):
-            acnt_name = traverse_account_hierarchy_backwards(accounts, account.get("id"))
-            rev_accounts[acnt_name] = account.get("id")
-
-        target_acnt_key = list(filter(lambda x: replace_target_account in x, rev_accounts.keys()))[0]
-        replace_target_acnt_id = rev_accounts[target_acnt_key]
-        replace_tag_in_account(transactions, tags, replace_target_acnt_id, old_tag, new_tag)
-
-    if "set_move_split_lvl_tag_to_txn_lvl" in vars():
-        if tag_to_move in tags.keys():
-            move_tag_from_split_level_to_txn_level(transactions, tags, tag_to_move, accounts)
+    if (len(args) == 1) and (not os.path.isdir(args[0])) and (not glob.has_magic(args[0])):
+        inputfile = args[0]
+        if outputfile is None:
+            if "to_diff" in fix_opts:
+                outputfile = default_changes_file(inputfile)
+            else:
+                outputfile = default_output_file(inputfile)
+        fix_file(inputfile, outputfile, fix_opts)
+        return
+
+    # ============== BATCH MODE =================
+    # Output file option names the output directory, files are processed in parallel instead of their transactions
+    fix_opts.pop("jobs", None)
+    if outputfile is not None:
+        os.makedirs(outputfile, exist_ok=True)
+    files = []
+    for inputfile in collect_input_files(args):
+        if "to_diff" in fix_opts:
+            k = default_changes_file(inputfile)
         else:
-            print(f"Tag {tag_to_move} was not found in the provided XML file.")
-
-    if "to_reorder_tags" in vars():
-        rev_tags = dict()
-        for k in root.findall("./TAGS/TAG"):
-            rev_tags[k.attrib["id"]] = k.attrib["name"]
-        reorder_tags_in_txn(transactions, rev_tags)
-
-    if "to_replace_payee" in vars():
-        rev_payees = dict()
-        for k in root.findall("./PAYEES/PAYEE"):
-            rev_payees[k.attrib["name"]] = k.attrib["id"]
-
-        if payee_for_replacement not in rev_payees.keys():
-            # Find the largest payee ID in the dictionary and 1 to it
-            id_payee_for_replacement = f"P{int(sorted(payees.keys())[-1][1:]) + 1}"
-            d = ET.SubElement(root.findall("./PAYEES")[0], "PAYEE")
-            d.attrib["id"] = id_payee_for_replacement
-            d.attrib["name"] = payee_for_replacement
-            d.attrib["email"] = ""
-            d.attrib["reference"] = ""
-            d.attrib["matchingenabled"] = ""
-            a = ET.SubElement(d, "ADDRESS")
-            a.attrib["telephone"] = ""
-            a.attrib["state"] = ""
-            a.attrib["city"] = ""
-            a.attrib["street"] = ""
-            a.attrib["postcode"] = ""
-            rev_payees[payee_for_replacement] = id_payee_for_replacement
-
-        replace_payee(transactions, payees, rev_payees, payee_pattern, payee_for_replacement)
-
-    # ============== OUTPUT =====================
-    xml_dmp = ET.tostring(root, encoding="utf8", xml_declaration=False)
-    # Some symbol combinations need to be escaped or replaced
-    rep_sym_dict = [
-        ('" />', '"/>'),
-        ("&gt;", ">"),
-        ("&#10;", "&#xa;"),
-        ("&#09;", "&#x9;"),
-    ]
-    # Replace a character array in 0st element of tuple with 1st element of tuple
-    for k in rep_sym_dict:
-        xml_dmp = xml_dmp.replace(bytes(k[0], "ascii"), bytes(k[1], "ascii"))
-
-    # Convert bytes to string in UTF-8 encoding
-    xml_dmp = xml_dmp.decode("utf8")
-
-    # Divide badly formatted multiple nodes on the same line
-    xml_dmp = xml_dmp.replace("><", ">\n<")
-
-    with open(outputfile, "w", encoding="UTF-8") as f:
-        doc_type = '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE KMYMONEY-FILE>\n'
-        file = f"{doc_type}{xml_dmp}\n"
-        f.write(file)
+            k = default_output_file(inputfile)
+        if outputfile is not None:
+            if "to_diff" in fix_opts:
+                k = os.path.join(outputfile, os.path.basename(k))
+            else:
+                k = os.path.join(outputfile, os.path.basename(inputfile))
+        files.append((inputfile, k))
+    if len(set(k[1] for k in files)) < len(files):
+        print("Several input files would be written to the same output file.")
+        sys.exit(2)
+    if len(fix_files(files, fix_opts, workers)) > 0:
+        sys.exit(1)
     return
 
 
@@ -0,0 +1,613 @@
+import gzip
+import json
+import os
+import re
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import kmymoney_utils as ku
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kmymoney_utils.py")
+
+# Small ledger in KMyMoney's own format: attributes with newlines, tabs and ">",
+# self-closing elements, an empty section and elements no fixer models (KEYVALUEPAIRS)
+LEDGER = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE KMYMONEY-FILE>
+<KMYMONEY-FILE>
+ <FILEINFO>
+  <CREATION_DATE date="2020-01-01"/>
+ </FILEINFO>
+ <INSTITUTIONS count="0"/>
+ <PAYEES count="2">
+  <PAYEE matchingenabled="0" email="" id="P000001" name="Shop A" reference="">
+   <ADDRESS telephone="" state="" city="" street="" postcode=""/>
+  </PAYEE>
+  <PAYEE matchingenabled="0" email="" id="P000002" name="Bank &lt;x>" reference=""/>
+ </PAYEES>
+ <TAGS count="2">
+  <TAG closed="0" tagcolor="#000000" id="G000001" name="household_1"/>
+  <TAG closed="0" tagcolor="#000000" id="G000002" name="household_2"/>
+ </TAGS>
+ <ACCOUNTS count="5">
+  <ACCOUNT id="AStd::Asset" parentaccount="" currency="EUR" type="9" name="Asset" description="">
+   <SUBACCOUNTS>
+    <SUBACCOUNT id="A000001"/>
+   </SUBACCOUNTS>
+  </ACCOUNT>
+  <ACCOUNT id="AStd::Expense" parentaccount="" currency="EUR" type="13" name="Expense" description="">
+   <SUBACCOUNTS>
+    <SUBACCOUNT id="A000002"/>
+   </SUBACCOUNTS>
+  </ACCOUNT>
+  <ACCOUNT id="A000001" parentaccount="AStd::Asset" currency="EUR" type="1" name="Checking" description=""/>
+  <ACCOUNT id="A000002" parentaccount="AStd::Expense" currency="EUR" type="13" name="Food" description="a&#xa;b"/>
+  <ACCOUNT id="A000003" parentaccount="AStd::Expense" currency="USD" type="13" name="Travel" description=""/>
+ </ACCOUNTS>
+ <TRANSACTIONS count="3">
+  <TRANSACTION id="T000000000000000001" postdate="2020-02-01" memo="" entrydate="2020-02-01" commodity="EUR">
+   <SPLITS>
+    <SPLIT payee="P000001" reconciledate="" shares="-1000/100" action="" bankid="" number="7" reconcileflag="0" memo="t&#x9;ab" value="-1000/100" price="1/1" account="A000001" id="S0001">
+     <TAG id="G000002"/>
+     <TAG id="G000001"/>
+    </SPLIT>
+    <SPLIT payee="" reconciledate="" shares="1000/100" action="" bankid="" number="" reconcileflag="0" memo="a > b" value="1000/100" price="1/1" account="A000002" id="S0002"/>
+   </SPLITS>
+   <KEYVALUEPAIRS>
+    <PAIR key="note" value="x&#xa;y"/>
+   </KEYVALUEPAIRS>
+  </TRANSACTION>
+  <TRANSACTION id="T000000000000000002" postdate="2020-01-15" memo="" entrydate="2020-01-15" commodity="EUR">
+   <SPLITS>
+    <SPLIT payee="P000002" reconciledate="" shares="-250/100" action="" bankid="" number="3" reconcileflag="1" memo="" value="-250/100" price="1/1" account="A000001" id="S0001"/>
+    <SPLIT payee="P000002" reconciledate="" shares="250/100" action="" bankid="" number="" reconcileflag="1" memo="" value="250/100" price="1/1" account="A000003" id="S0002">
+     <TAG id="G000001"/>
+    </SPLIT>
+   </SPLITS>
+  </TRANSACTION>
+  <TRANSACTION id="T000000000000000003" postdate="2020-03-01" memo="" entrydate="2020-03-01" commodity="EUR">
+   <SPLITS>
+    <SPLIT payee="P000001" reconciledate="" shares="-1/100" action="" bankid="" number="" reconcileflag="2" memo="" value="-1/100" price="1/1" account="A000001" id="S0001"/>
+    <SPLIT payee="P000001" reconciledate="" shares="1/100" action="" bankid="" number="" reconcileflag="2" memo="" value="1/100" price="1/1" account="A000002" id="S0002"/>
+   </SPLITS>
+  </TRANSACTION>
+ </TRANSACTIONS>
+ <KEYVALUEPAIRS>
+  <PAIR key="kmm-id" value="{x}"/>
+ </KEYVALUEPAIRS>
+ <SCHEDULES count="0"/>
+ <REPORTS count="0"/>
+</KMYMONEY-FILE>
+"""
+
+
+# Same ledger without any whitespace between elements
+COMPACT_LEDGER = re.sub(r">\s+<", "><", LEDGER)
+
+# Empty sections, with and without attributes, self-closing or not
+EMPTY_LEDGER = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE KMYMONEY-FILE>
+<KMYMONEY-FILE>
+ <PAYEES></PAYEES>
+ <TAGS count="0"/>
+ <ACCOUNTS count="0"></ACCOUNTS>
+ <TRANSACTIONS count="0"/>
+ <KEYVALUEPAIRS/>
+</KMYMONEY-FILE>
+"""
+
+
+def write_ledger(path, text=LEDGER):
+    with open(path, "w", encoding="UTF-8") as f:
+        f.write(text)
+    return str(path)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def run_script(*args):
+    return subprocess.run([sys.executable, SCRIPT, *args], capture_output=True, text=True)
+
+
+def test_stream_fix_in_place(tmp_path):
+    # Input is read while the output is written, so it must not be truncated beforehand
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    expected = tmp_path / "expected.xml"
+    assert run_script("-e", "-S", "-o", str(expected), inputfile).returncode == 0
+    assert run_script("-e", "-S", "-o", inputfile, inputfile).returncode == 0
+    assert read_file(inputfile) == read_file(expected)
+    assert sorted(os.listdir(tmp_path)) == ["expected.xml", "ledger.xml"]
+
+
+@pytest.mark.parametrize("jobs", [[], ["-j", "2"]], ids=["serial", "parallel"])
+def test_section_fix_in_place(tmp_path, jobs):
+    # Input is memory-mapped while the output is written, so it must not be truncated beforehand
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    expected = tmp_path / "expected.xml"
+    assert run_script("-e", *jobs, "-o", str(expected), inputfile).returncode == 0
+    assert run_script("-e", *jobs, "-o", inputfile, inputfile).returncode == 0
+    assert read_file(inputfile) == read_file(expected)
+    assert sorted(os.listdir(tmp_path)) == ["expected.xml", "ledger.xml"]
+
+
+def test_batch_in_place(tmp_path):
+    # Output directory is the directory of the input files
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    expected = tmp_path / "expected.xml"
+    assert run_script("-e", "-o", str(expected), write_ledger(tmp_path / "ledger.xml")).returncode == 0
+    for name in ["a.xml", "b.xml"]:
+        write_ledger(inputs / name)
+    result = run_script("-e", "-o", str(inputs), str(inputs))
+    assert result.returncode == 0
+    assert "Processed files: 2 of 2" in result.stdout
+    for name in ["a.xml", "b.xml"]:
+        assert read_file(inputs / name) == read_file(expected)
+    assert sorted(os.listdir(inputs)) == ["a.xml", "b.xml"]
+
+
+def test_batch_skips_previous_output(tmp_path):
+    # Repeated runs over a directory or a glob pattern do not fix their own output again
+    for name in ["a.xml", "b.kmy", "notes.txt"]:
+        write_ledger(tmp_path / name)
+    for pattern in [str(tmp_path), str(tmp_path / "*"), str(tmp_path / "*.xml")]:
+        for k in range(2):
+            assert run_script("-e", pattern).returncode == 0
+    assert sorted(os.listdir(tmp_path)) == ["a.xml", "a_fixed.xml", "b.kmy", "b_fixed.kmy", "notes.txt"]
+
+
+def gzip_name(path):
+    # File name stored in the gzip header (FNAME field follows the 10-byte header)
+    data = read_file(path)
+    assert data[3] & 0x08
+    return data[10:data.index(b"\0", 10)].decode("latin-1")
+
+
+@pytest.mark.parametrize("mode", [[], ["-S"]], ids=["sections", "stream"])
+def test_compressed_output_name(tmp_path, mode):
+    # Output is written under a temporary name, the gzip header holds the name of the output file
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    assert run_script("-e", *mode, "-o", str(tmp_path / "ledger.kmy"), inputfile).returncode == 0
+    assert gzip_name(tmp_path / "ledger.kmy") == "ledger.kmy"
+
+
+def test_failed_run_keeps_output(tmp_path):
+    inputfile = write_ledger(tmp_path / "ledger.xml", LEDGER[:LEDGER.index("<TRANSACTIONS")])
+    outputfile = write_ledger(tmp_path / "out.xml", "previous")
+    assert run_script("-e", "-S", "-o", outputfile, inputfile).returncode != 0
+    assert read_file(outputfile) == b"previous"
+    assert sorted(os.listdir(tmp_path)) == ["ledger.xml", "out.xml"]
+
+
+def tostring_output(inputfile):
+    # Output of the original implementation: ET.tostring followed by replacements of symbols
+    root = ET.parse(inputfile, parser=ET.XMLParser(encoding="utf-8")).getroot()
+    xml_dmp = ET.tostring(root, encoding="utf8", xml_declaration=False)
+    for old, new in [('" />', '"/>'), ("&gt;", ">"), ("&#10;", "&#xa;"), ("&#09;", "&#x9;")]:
+        xml_dmp = xml_dmp.replace(bytes(old, "ascii"), bytes(new, "ascii"))
+    xml_dmp = xml_dmp.decode("utf8").replace("><", ">\n<")
+    doc_type = '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE KMYMONEY-FILE>\n'
+    return f"{doc_type}{xml_dmp}\n".encode("utf8")
+
+
+@pytest.mark.parametrize("text", [LEDGER, COMPACT_LEDGER, EMPTY_LEDGER], ids=["ledger", "compact", "empty"])
+def test_writer_matches_tostring(tmp_path, text):
+    # KMyMoneyWriter writes elements and the model byte for byte as the original implementation did
+    inputfile = write_ledger(tmp_path / "ledger.xml", text)
+    expected = tostring_output(inputfile)
+    root = ET.parse(inputfile, parser=ET.XMLParser(encoding="utf-8")).getroot()
+    ku.write_output(root, str(tmp_path / "elements.xml"))
+    assert read_file(tmp_path / "elements.xml") == expected
+    root, transactions = ku.load_document(inputfile)
+    ku.write_output(root, str(tmp_path / "model.xml"), transactions=transactions)
+    assert read_file(tmp_path / "model.xml") == expected
+
+
+def test_writer_escaping():
+    # Symbols which KMyMoney escapes differently from ElementTree
+    assert ku.escape_attrib('a > b\n\t"&<') == 'a > b&#xa;&#x9;&quot;&amp;&lt;'
+    assert ku.escape_text("a > b & c < d") == "a > b &amp; c &lt; d"
+
+
+@pytest.mark.parametrize("jobs", [[], ["-j", "2"]], ids=["serial", "parallel"])
+def test_cache_matches_uncached_run(tmp_path, jobs):
+    # Transactions found in the cache are copied without being parsed, the output stays the same
+    fixers = ["-e", "-a", "household_1", "-t", *jobs]
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    expected = tmp_path / "expected.xml"
+    assert run_script(*fixers, "-o", str(expected), inputfile).returncode == 0
+    for hits in [0, 3]:
+        result = run_script(*fixers, "--cache", "-o", str(tmp_path / "out.xml"), inputfile)
+        assert f"Cache: {hits} of 3 transactions were copied without being parsed." in result.stdout
+        assert read_file(tmp_path / "out.xml") == read_file(expected)
+
+    # Changed transaction is fixed again
+    write_ledger(inputfile, LEDGER.replace('memo="a > b"', 'memo="c"'))
+    assert run_script(*fixers, "-o", str(expected), inputfile).returncode == 0
+    result = run_script(*fixers, "--cache", "-o", str(tmp_path / "out.xml"), inputfile)
+    assert "Cache: 2 of 3 transactions were copied without being parsed." in result.stdout
+    assert read_file(tmp_path / "out.xml") == read_file(expected)
+
+
+def test_writer_flushes_transactions(tmp_path):
+    # Serialized transactions are written out in blocks, so that streaming does not keep the output in memory
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    root, transactions = ku.load_document(inputfile)
+    out = ku.KMyMoneyWriter(ku.io.StringIO(), max_parts=8)
+    for k in range(100):
+        out.transaction(transactions[k % len(transactions)])
+        assert len(out.parts) < 8
+
+
+def snapshot_value(snapshot, split, name):
+    # Attribute of a transaction (split is None) or an attribute or tags of its split
+    if split is None:
+        return snapshot[0].get(name)
+    attrs, tags = snapshot[1][split]
+    return tags if name == "TAG" else attrs.get(name)
+
+
+def test_diff_matches_fixed_run(tmp_path):
+    # Change log leads from every changed transaction of the input to the one in the fixed file
+    fixers = ["-e", "-r", "2", "-a", "household_1", "-m", "household_2", "-t"]
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    assert run_script(*fixers, "-o", str(tmp_path / "fixed.xml"), inputfile).returncode == 0
+    result = run_script(*fixers, "--diff", "-o", str(tmp_path / "changes.jsonl"), inputfile)
+    assert result.returncode == 0
+    with open(tmp_path / "changes.jsonl", encoding="UTF-8") as f:
+        records = [json.loads(line) for line in f]
+    before = {txn.id: ku.transaction_snapshot(txn) for txn in ku.load_document(inputfile)[1]}
+    after = {txn.id: ku.transaction_snapshot(txn) for txn in ku.load_document(str(tmp_path / "fixed.xml"))[1]}
+    changed = {record["txn"]: record["changes"] for record in records}
+    assert set(changed) == {txn_id for txn_id in before if before[txn_id] != after[txn_id]}
+    for txn_id, changes in changed.items():
+        # The first change of an attribute or tags starts from the input, the last one ends in the output
+        values = dict()
+        for change in changes:
+            key = (change.get("split"), change.get("attribute", "TAG"))
+            values.setdefault(key, [snapshot_value(before[txn_id], *key)])
+            assert values[key][-1] == change["old"]
+            values[key].append(change["new"])
+        for key, chain in values.items():
+            assert chain[-1] == snapshot_value(after[txn_id], *key)
+    n_changes = sum(len(changes) for changes in changed.values())
+    assert f"Dry run: {n_changes} changes, {n_changes} of them in {len(changed)} transactions" in result.stdout
+
+
+def test_diff_without_changes(tmp_path):
+    # Change log is not written if the fixers would not change anything
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    assert run_script("-e", "-o", str(tmp_path / "fixed.xml"), inputfile).returncode == 0
+    result = run_script("-e", "--diff", str(tmp_path / "fixed.xml"))
+    assert result.returncode == 0
+    assert "nothing would be changed" in result.stdout
+    assert sorted(os.listdir(tmp_path)) == ["fixed.xml", "ledger.xml"]
+
+
+@pytest.mark.parametrize("mode", [[], ["-S"], ["-j", "2"]], ids=["sections", "stream", "parallel"])
+def test_numbers_chronological(tmp_path, mode):
+    # Splits of asset accounts are numbered by post date, transactions of the same date keep their
+    # order in the file. Asset accounts are found by ID, the top-level account may have any name.
+    text = LEDGER.replace('name="Asset"', 'name="Vermögen"')
+    text = text.replace('postdate="2020-03-01"', 'postdate="2020-02-01"')
+    inputfile = write_ledger(tmp_path / "ledger.xml", text)
+    assert run_script("-n", *mode, "-o", str(tmp_path / "fixed.xml"), inputfile).returncode == 0
+    transactions = ku.load_document(str(tmp_path / "fixed.xml"))[1]
+    assert [[spl.number for spl in txn.splits] for txn in transactions] == [["2", ""], ["1", ""], ["3", ""]]
+
+
+REPORT_HEADER = "txn_id,postdate,account,account_type,payee,tags,amount,currency"
+REPORT_ROWS = [
+    'T000000000000000001,2020-02-01,Assets:Checking,Checkings,Shop A,"household_2,household_1",-10,EUR',
+    "T000000000000000001,2020-02-01,Expenses:Food,Expense,,,10,EUR",
+    "T000000000000000002,2020-01-15,Assets:Checking,Checkings,Bank <x>,,-2.5,EUR",
+    "T000000000000000002,2020-01-15,Expenses:Travel,Expense,Bank <x>,household_1,2.5,USD",
+    "T000000000000000003,2020-03-01,Assets:Checking,Checkings,Shop A,,-0.01,EUR",
+    "T000000000000000003,2020-03-01,Expenses:Food,Expense,Shop A,,0.01,EUR",
+]
+
+
+@pytest.mark.parametrize("filters, rows", [
+    ([], [0, 1, 2, 3, 4, 5]),
+    (["--account", "Checking"], [0, 2, 4]),
+    (["--account", "Expenses:"], [1, 3, 5]),
+    (["--from", "2020-02-01"], [0, 1, 4, 5]),
+    (["--to", "2020-02-01"], [0, 1, 2, 3]),
+    (["--from", "2020-01-20", "--to", "2020-02-20"], [0, 1]),
+    (["--tag", "household_1"], [0, 3]),
+    (["--tag", "household_2", "--account", "Food"], []),
+    (["--account", "Checking", "--from", "2020-01-20", "--tag", "household_1"], [0]),
+], ids=["all", "account", "account-prefix", "from", "to", "from-to", "tag", "tag-account", "combined"])
+def test_report_csv(tmp_path, filters, rows):
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    outputfile = str(tmp_path / "report.csv")
+    assert run_script("--report", *filters, "-o", outputfile, inputfile).returncode == 0
+    assert read_file(outputfile).decode("UTF-8").splitlines() == [REPORT_HEADER] + [REPORT_ROWS[k] for k in rows]
+
+
+@pytest.mark.parametrize("extension", ["parquet", "arrow"])
+def test_report_arrow_types(tmp_path, extension):
+    # Post dates are dates and amounts decimals, non-terminating amounts are rounded
+    pyarrow = pytest.importorskip("pyarrow")
+    import datetime
+    from decimal import Decimal
+    text = LEDGER.replace('value="250/100" price="1/1"', 'value="250/100" price="1/3"')
+    inputfile = write_ledger(tmp_path / "ledger.xml", text)
+    outputfile = str(tmp_path / ("report." + extension))
+    assert run_script("--report", "-o", outputfile, inputfile).returncode == 0
+    if extension == "parquet":
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(outputfile)
+    else:
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(outputfile)
+    assert table.schema.field("postdate").type == pyarrow.date32()
+    assert table.schema.field("amount").type == pyarrow.decimal128(38, 12)
+    assert table.schema.field("txn_id").type == pyarrow.string()
+    assert table.column("postdate").to_pylist()[2:4] == [datetime.date(2020, 1, 15)] * 2
+    assert table.column("amount").to_pylist()[:4] == [
+        Decimal("-10"), Decimal("10"), Decimal("-2.5"), Decimal("0.833333333333")]
+
+
+# Ledger with a transaction whose splits do not balance, a split whose value differs from
+# shares times price, and references to an account and a tag which do not exist
+INVALID_LEDGER = LEDGER.replace(
+    'shares="1000/100" action="" bankid="" number="" reconcileflag="0" memo="a > b" value="1000/100"',
+    'shares="900/100" action="" bankid="" number="" reconcileflag="0" memo="a > b" value="900/100"').replace(
+    'value="250/100" price="1/1"', 'value="250/100" price="1/3"').replace(
+    'value="1/100" price="1/1" account="A000002"', 'value="1/100" price="1/1" account="A000009"').replace(
+    '<TAG id="G000002"/>', '<TAG id="G000009"/>')
+
+
+def test_validate_valid(tmp_path):
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    result = run_script("--validate", inputfile)
+    assert result.returncode == 0
+    assert "Count of transactions whose splits do not balance: 0" in result.stdout
+    assert read_file(tmp_path / "ledger_balances.csv").decode("UTF-8").splitlines() == [
+        "account,postdate,txn_id,shares,balance",
+        "Assets:Checking,2020-01-15,T000000000000000002,-2.5,-2.5",
+        "Assets:Checking,2020-02-01,T000000000000000001,-10,-12.5",
+        "Assets:Checking,2020-03-01,T000000000000000003,-0.01,-12.51",
+        "Expenses:Food,2020-02-01,T000000000000000001,10,10",
+        "Expenses:Food,2020-03-01,T000000000000000003,0.01,10.01",
+        "Expenses:Travel,2020-01-15,T000000000000000002,2.5,2.5",
+    ]
+
+
+def test_validate_invalid(tmp_path):
+    inputfile = write_ledger(tmp_path / "ledger.xml", INVALID_LEDGER)
+    result = run_script("--validate", "-o", str(tmp_path / "balances.csv"), inputfile)
+    assert result.returncode == 1
+    lines = result.stdout.splitlines()
+    assert "Transaction T000000000000000001 (2020-02-01): splits do not balance, sum of values is -1." in lines
+    assert "Transaction T000000000000000002 split 1: value 2.5 differs from shares times price 5/6." in lines
+    assert "Transaction T000000000000000003 split 1: account A000009 does not exist." in lines
+    assert "Transaction T000000000000000001 split 0: tag G000009 does not exist." in lines
+    assert "Count of transactions whose splits do not balance: 1" in lines
+    assert "Count of splits whose value differs from shares times price: 1" in lines
+    assert "Count of references to accounts, payees and tags which do not exist: 2" in lines
+    # Balances are written anyway, accounts which do not exist by their ID
+    balances = read_file(tmp_path / "balances.csv").decode("UTF-8").splitlines()
+    assert "A000009,2020-03-01,T000000000000000003,0.01,0.01" in balances
+
+
+def test_validate_without_numpy(tmp_path, monkeypatch, capsys):
+    # Pure Python checks find the same problems
+    inputfile = write_ledger(tmp_path / "ledger.xml", INVALID_LEDGER)
+    result = run_script("--validate", "-o", str(tmp_path / "balances.csv"), inputfile)
+    monkeypatch.setattr(ku, "numpy", None)
+    assert not ku.validate_file(inputfile, str(tmp_path / "balances_python.csv"), {"to_validate": True})
+    assert capsys.readouterr().out.replace("balances_python.csv", "balances.csv") == result.stdout
+    assert read_file(tmp_path / "balances_python.csv") == read_file(tmp_path / "balances.csv")
+
+
+def random_amounts(rng, count):
+    # Numerators and denominators: small and large ones, beyond 64 bits, shared and mixed denominators
+    nums = []
+    dens = []
+    for k in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            nums.append(rng.randrange(-10**6, 10**6))
+        elif kind == 1:
+            nums.append(rng.randrange(-2**61, 2**61))
+        elif kind == 2:
+            nums.append(rng.choice([-1, 1]) * rng.randrange(2**62, 2**70))
+        else:
+            nums.append(0)
+        dens.append(rng.choice([100, 100, 100, 1, 3, 10**18, 2**63]))
+    return nums, dens
+
+
+def with_and_without_numpy(monkeypatch, func, *args):
+    result = func(*args)
+    with monkeypatch.context() as m:
+        m.setattr(ku, "numpy", None)
+        return result, func(*args)
+
+
+def test_int64_array_masks_overflow():
+    pytest.importorskip("numpy")
+    array, valid = ku.int64_array([5, 2**62, -2**62, 2**62 - 1, 2**70, -2**63 - 5])
+    assert array.tolist() == [5, 0, 0, 2**62 - 1, 0, 0]
+    assert valid.tolist() == [True, False, False, True, False, False]
+    array, valid = ku.int64_array([2**63 - 1, -7])
+    assert array.tolist() == [0, -7]
+    assert valid.tolist() == [False, True]
+
+
+def test_summable_groups():
+    numpy = pytest.importorskip("numpy")
+    nums, valid = ku.int64_array([1, 2, 3, 4, 2**61, 2**61, 2**61, -2**60, 2**62, 5])
+    dens = numpy.array([100, 100, 100, 10, 1, 1, 1, 1, 7, 7])
+    starts = numpy.array([0, 2, 4, 6, 8])
+    # Shared denominator, mixed denominators, sum of absolute numerators at the limit and
+    # below it, a numerator out of the limit
+    assert ku.summable_groups(nums, valid, dens, starts).tolist() == [True, False, False, True, False]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_transaction_sums_numpy(monkeypatch, seed):
+    pytest.importorskip("numpy")
+    import random
+    from fractions import Fraction
+    rng = random.Random(seed)
+    split_txns = sorted(rng.randrange(300) for k in range(1000))
+    nums, dens = random_amounts(rng, len(split_txns))
+    # Transactions balancing exactly in 64-bit integers
+    for k in range(0, 40, 2):
+        split_txns += [1000 + k, 1000 + k, 1001 + k]
+        nums += [2**61 - 1, 2**61 - 1, -2**62 + 2]
+        dens += [100] * 3
+    with_numpy, without_numpy = with_and_without_numpy(monkeypatch, ku.transaction_sums, split_txns, nums, dens)
+    assert with_numpy == without_numpy
+    expected = dict()
+    for i, num, den in zip(split_txns, nums, dens):
+        expected[i] = expected.get(i, 0) + Fraction(num, den)
+    assert {i: Fraction(*k) for i, k in with_numpy.items()} == {i: k for i, k in expected.items() if k != 0}
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_price_mismatches_numpy(monkeypatch, seed):
+    pytest.importorskip("numpy")
+    import random
+    from fractions import Fraction
+    rng = random.Random(seed)
+    shares = random_amounts(rng, 1000)
+    prices = (([1] * 500) + [rng.randrange(1, 10**6) for k in range(500)],
+              ([1] * 500) + [rng.choice([1, 100, 3, 10**9]) for k in range(500)])
+    # Values are shares times price rounded to the denominator, some of them off by one unit
+    value_dens = [rng.choice([100, 1, 10**18]) for k in range(1000)]
+    value_nums = [round(Fraction(s_n, s_d) * Fraction(p_n, p_d) * v_d) + rng.choice([0, 0, 0, 1])
+                  for s_n, s_d, p_n, p_d, v_d in zip(*shares, *prices, value_dens)]
+    values = (value_nums, value_dens)
+    with_numpy, without_numpy = with_and_without_numpy(monkeypatch, ku.price_mismatches, shares, prices, values)
+    assert with_numpy == without_numpy
+    assert with_numpy == [k for k in range(1000)
+                          if abs(Fraction(values[0][k], values[1][k])
+                                 - Fraction(shares[0][k], shares[1][k]) * Fraction(prices[0][k], prices[1][k]))
+                          > Fraction(1, 2 * values[1][k])]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_running_balances_numpy(monkeypatch, seed):
+    pytest.importorskip("numpy")
+    import random
+    from fractions import Fraction
+    rng = random.Random(seed)
+    split_acnts = [rng.randrange(50) for k in range(1000)]
+    split_dates = [f"2020-{rng.randrange(1, 13):02d}-01" for k in range(1000)]
+    nums, dens = random_amounts(rng, 1000)
+    # Accounts sharing the denominator whose balances fit into 64-bit integers, while
+    # cumulative sums across them do not
+    for k in range(6):
+        split_acnts += [100 + k, 100 + k]
+        split_dates += ["2020-01-01", "2020-01-02"]
+        nums += [2**61 - 1, 2**61 - 1]
+        dens += [100, 100]
+    with_numpy, without_numpy = with_and_without_numpy(
+        monkeypatch, ku.running_balances, split_acnts, split_dates, nums, dens)
+    assert with_numpy == without_numpy
+    order, balances = with_numpy
+    assert order == sorted(range(len(nums)), key=lambda k: (split_acnts[k], split_dates[k]))
+    expected = dict()
+    for k, balance in zip(order, balances):
+        expected[split_acnts[k]] = expected.get(split_acnts[k], 0) + Fraction(nums[k], dens[k])
+        assert Fraction(*balance) == expected[split_acnts[k]]
+    assert balances[-2:] == [(2**61 - 1, 100), (2**62 - 2, 100)]
+
+
+def write_compressed_ledger(path, text=LEDGER):
+    with gzip.open(path, "wt", encoding="UTF-8") as f:
+        f.write(text)
+    return str(path)
+
+
+@pytest.mark.parametrize("mode", [[], ["-S"], ["-j", "2"]], ids=["sections", "stream", "parallel"])
+def test_compressed_round_trip(tmp_path, mode):
+    # Compressed input gives compressed output with the same content as plain input
+    write_ledger(tmp_path / "plain.xml")
+    write_compressed_ledger(tmp_path / "ledger.kmy")
+    assert run_script("-e", *mode, str(tmp_path / "plain.xml")).returncode == 0
+    assert run_script("-e", *mode, str(tmp_path / "ledger.kmy")).returncode == 0
+    data = read_file(tmp_path / "ledger_fixed.kmy")
+    assert data.startswith(ku.GZIP_MAGIC)
+    assert gzip.decompress(data) == read_file(tmp_path / "plain_fixed.xml")
+
+
+def test_compressed_input_by_content(tmp_path):
+    # Input is decompressed if it is compressed, whatever its extension is, and
+    # output is written as plain XML for the ".xml" extension
+    write_ledger(tmp_path / "plain.xml")
+    write_compressed_ledger(tmp_path / "ledger.xml")
+    assert run_script("-e", str(tmp_path / "plain.xml")).returncode == 0
+    assert run_script("-e", str(tmp_path / "ledger.xml")).returncode == 0
+    assert read_file(tmp_path / "ledger_fixed.xml") == read_file(tmp_path / "plain_fixed.xml")
+
+
+@pytest.mark.parametrize("level, xfl", [("1", 4), ("6", 0), ("9", 2)])
+def test_compression_level(tmp_path, level, xfl):
+    # "-z" compresses output regardless of its extension, the level is recorded
+    # in the extra flags of the gzip header (4 for the fastest, 2 for the best)
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    assert run_script("-e", "-z", level, "-o", str(tmp_path / "fixed.xml"), inputfile).returncode == 0
+    assert run_script("-e", "-o", str(tmp_path / "plain.xml"), inputfile).returncode == 0
+    data = read_file(tmp_path / "fixed.xml")
+    assert data.startswith(ku.GZIP_MAGIC)
+    assert data[8] == xfl
+    assert gzip.decompress(data) == read_file(tmp_path / "plain.xml")
+
+
+def test_compression_level_invalid(tmp_path):
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    assert run_script("-e", "-z", "10", inputfile).returncode == 2
+    assert not os.path.exists(tmp_path / "ledger_fixed.xml")
+
+
+def split_payee_names(path):
+    # Names of the payees of all splits of a file
+    root, transactions = ku.load_document(str(path))
+    names = {payee.get("id"): payee.get("name") for payee in root.iterfind("./PAYEES/PAYEE")}
+    return [[names.get(spl.payee, "") for spl in txn.splits] for txn in transactions]
+
+
+RULES = """# Payee rules
+
+^Shop => Groceries
+  ^Shop A => Other
+^Bank => Banks
+"""
+
+
+@pytest.mark.parametrize("options, payees", [
+    ([], [["Groceries", "Groceries"], ["Banks", "Banks"], ["Groceries", "Groceries"]]),
+    (["-p", "^Bank", "-u", "Other"], [["Groceries", "Groceries"], ["Other", "Other"], ["Groceries", "Groceries"]]),
+], ids=["rules", "pattern-first"])
+def test_payee_rules(tmp_path, options, payees):
+    # Comments and empty lines are skipped, the first matching rule wins and
+    # the rule given by "-p" and "-u" is checked before the rules from the file
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    rulesfile = write_ledger(tmp_path / "rules.txt", RULES)
+    assert run_script("-R", rulesfile, *options, "-o", str(tmp_path / "fixed.xml"), inputfile).returncode == 0
+    assert split_payee_names(tmp_path / "fixed.xml") == payees
+
+
+@pytest.mark.parametrize("rules, message", [
+    ("^Shop => Groceries\n^Bank = Banks\n", 'Line 2 of payee rules file {} is not "<pattern> => <payee>".'),
+    ("# Payee rules\n => Banks\n", 'Line 2 of payee rules file {} is not "<pattern> => <payee>".'),
+    ("^Shop => \n", 'Line 1 of payee rules file {} is not "<pattern> => <payee>".'),
+    ("\n^(Shop => Groceries\n", "Line 2 of payee rules file {} has an invalid pattern"),
+], ids=["separator", "pattern", "payee", "regex"])
+def test_payee_rules_invalid(tmp_path, rules, message):
+    inputfile = write_ledger(tmp_path / "ledger.xml")
+    rulesfile = write_ledger(tmp_path / "rules.txt", rules)
+    result = run_script("-R", rulesfile, inputfile)
+    assert result.returncode == 2
+    assert message.format(rulesfile) in result.stdout
+    assert not os.path.exists(tmp_path / "ledger_fixed.xml")